@@ -8,7 +8,7 @@
 #     Created by David Stack (Chapman University - Orange, CA) on 1/26/2012
 #==============================================================================
 
-import os
+import os, re, copy
 import lxml.etree as ET
 
 def new_document(version='', name=''):
@@ -207,4 +207,271 @@ def save_file(doc, filename, outputFileDir):
     with open(saveLocation, 'wb') as f:
         xmlpretty = ET.tostring(doc, pretty_print=True, encoding='UTF-8')
         f.write(xmlpretty)
-    return filename
\ No newline at end of file
+    return filename
+
+def _get_path_name(element):
+    '''Name of an element in a shortcut path (its name, else its tag).'''
+    return element.get('name', element.tag)
+
+def find_shortcut(doc, shortcut):
+    '''Finds the element a shortcut path (ie '/project/simulation/paddock')
+    points to. Returns None if there is no such element.'''
+    names = [name for name in shortcut.split('/') if name != '']
+    if names == [] or _get_path_name(doc) != names[0]:
+        return None
+    element = doc
+    for name in names[1:]:
+        for child in element:
+            if isinstance(child.tag, basestring) and _get_path_name(child) == name:
+                element = child
+                break
+        else:
+            return None
+    return element
+
+def _resolve_shortcuts(element, doc, cache, resolving):
+    ''' Copies element, replacing shortcuts the way APSIM reads them: a
+    shortcut takes the contents of its target, while child elements it has
+    itself (ie a soil in a paddock shortcut) are kept and replace the
+    target's children with the same tag.'''
+    if not isinstance(element.tag, basestring): # comments
+        return copy.deepcopy(element)
+    
+    shortcut = element.get('shortcut')
+    attrib = dict(element.attrib)
+    targetChildren = []
+    if shortcut != None:
+        if shortcut not in cache:
+            if shortcut in resolving:
+                raise ValueError('circular shortcut: ' + shortcut)
+            target = find_shortcut(doc, shortcut)
+            if target is None:
+                raise ValueError('shortcut target not found: ' + shortcut)
+            resolving.add(shortcut)
+            cache[shortcut] = _resolve_shortcuts(target, doc, cache, resolving)
+            resolving.remove(shortcut)
+        target = cache[shortcut]
+        attrib = dict(target.attrib, **attrib)
+        del attrib['shortcut']
+        ownTags = set(child.tag for child in element)
+        targetChildren = [child for child in target if child.tag not in ownTags]
+        text = target.text
+    else:
+        text = element.text
+    
+    resolved = ET.Element(element.tag, attrib)
+    resolved.text = text
+    resolved.tail = element.tail
+    for child in targetChildren:
+        resolved.append(copy.deepcopy(child))
+    for child in element:
+        resolved.append(_resolve_shortcuts(child, doc, cache, resolving))
+    return resolved
+
+def resolve_shortcuts(element, doc, cache=None):
+    '''
+    Copies element with every shortcut replaced by what it points to, so
+    the copy no longer depends on the rest of doc.
+    
+    Parameters
+    ----------
+    element : lxml element
+        element to copy, ie a simulation
+    doc : lxml element
+        root document the shortcut paths start from
+    cache : dictionary
+        (optional) resolved targets by shortcut path, shared between calls
+        so each target is only resolved once
+    
+    Returns
+    -------
+    The copy with no shortcuts.
+    '''
+    if cache == None:
+        cache = {}
+    return _resolve_shortcuts(element, doc, cache, set())
+
+def _save_simulation(simulation, doc, cache, outputFileDir):
+    '''Saves simulation with shortcuts resolved to its own .apsim file.'''
+    simulationDoc = ET.Element(doc.tag, doc.attrib)
+    simulationDoc.append(resolve_shortcuts(simulation, doc, cache))
+    return save_file(simulationDoc, simulation.get('name') + '.apsim', outputFileDir)
+
+def save_simulations(doc, outputFileDir):
+    '''
+    Saves each simulation in doc to its own .apsim file, named after the
+    simulation, with shortcuts resolved. Each file can then be converted to
+    a .sim file on its own and in parallel with the others.
+    
+    Parameters
+    ----------
+    doc : lxml element
+        root document
+    outputFileDir : string
+        directory to save the files to
+    
+    Returns
+    -------
+    List of the .apsim filenames saved.
+    '''
+    cache = {}
+    filenames = []
+    for simulation in doc.iter('simulation'):
+        filenames.append(_save_simulation(simulation, doc, cache, outputFileDir))
+    return filenames
+
+def _write_elements(f, doc):
+    '''Coroutine writing the start tag of doc to f, then each element (or
+    serialized element) sent to it, then the end tag of doc when it is
+    closed.'''
+    with ET.xmlfile(f, encoding='UTF-8') as xf:
+        with xf.element(doc.tag, doc.attrib):
+            xf.write('\n')
+            try:
+                while True:
+                    element = (yield)
+                    if isinstance(element, basestring):
+                        xf.flush()
+                        f.write(element)
+                    else:
+                        xf.write(element, pretty_print=True)
+            except GeneratorExit:
+                pass
+
+# fields of a SimulationTemplate, ie @@simName@@
+_templateField = re.compile(r'@@(\w+)@@')
+
+def _escape(value):
+    '''Escapes a value for XML text or attributes.'''
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+def template_field(name):
+    '''Placeholder for field name in an element used as a SimulationTemplate.'''
+    return '@@' + name + '@@'
+
+class SimulationTemplate:
+    '''
+    A simulation serialized once, from which simulations that only differ in
+    a few values are made by filling in those values.
+    
+    Build the simulation with template_field(name) in place of each value
+    that changes (in attributes or text), ie
+    new_summaryfile(simulation, template_field('simName') + '.sum').
+    
+    Attributes
+    ----------
+    fields : list
+        names of the fields to fill in
+    '''
+    def __init__(self, simulation):
+        xml = ET.tostring(simulation, pretty_print=True, encoding='UTF-8')
+        # the XML declaration is written once for the whole file
+        if xml.startswith('<?xml'):
+            xml = xml[xml.index('?>') + 2:].lstrip()
+        parts = _templateField.split(xml)
+        self.fields = sorted(set(parts[1::2]))
+        
+        # as a format string, ie '<simulation name="%(simName)s">...'
+        text = [part.replace('%', '%%') for part in parts[0::2]]
+        fields = ['%(' + field + ')s' for field in parts[1::2]]
+        self._format = ''.join(text[0:1] + [field + part for field, part in zip(fields, text[1:])])
+    
+    def fill(self, values):
+        '''
+        Serialized simulation with the template fields replaced.
+        
+        Parameters
+        ----------
+        values : dictionary
+            'field':'value' mapping, with a value for each of fields
+        
+        Returns
+        -------
+        The simulation as an XML string.
+        '''
+        return self._format % dict((field, _escape(values[field])) for field in self.fields)
+
+# drops the whitespace of pretty printed XML, so it is printed again in line
+# with the rest of the document
+_blankTextParser = ET.XMLParser(remove_blank_text=True)
+
+class SimulationWriter:
+    '''
+    Saves the simulations of a document as they are created, instead of
+    holding every simulation in memory until the document is saved.
+    
+    Create the writer once doc has everything the simulations have
+    shortcuts to (shared folders and the base simulation), which stays in
+    doc. Then add() each new simulation and close() when done. Added
+    simulations are removed from doc, so memory use does not grow with the
+    number of grid points.
+    
+    Attributes
+    ----------
+    doc : lxml element
+        root document
+    filename : string
+        .apsim filename to save doc to
+    outputFileDir : string
+        directory to save the files to
+    stream : bool
+        if False, simulations are kept in doc and it is saved by close()
+    split : bool
+        if True, each simulation is saved to its own .apsim file (see
+        save_simulations) rather than all of them to filename
+    '''
+    def __init__(self, doc, filename, outputFileDir, stream=True, split=False):
+        self.doc = doc
+        self.filename = filename
+        self.outputFileDir = outputFileDir
+        self.stream = stream
+        self.split = split
+        self.filenames = []
+        self._cache = {}
+        self._file = None
+        self._writer = None
+        if split:
+            for simulation in doc.iter('simulation'):
+                self.filenames.append(_save_simulation(simulation, doc, self._cache, outputFileDir))
+        elif stream:
+            self._file = open(os.path.join(outputFileDir, filename), 'wb')
+            self._writer = _write_elements(self._file, doc)
+            next(self._writer)
+            for element in doc:
+                self._writer.send(element)
+    
+    def add(self, simulation):
+        '''Saves a simulation of doc (if streaming or splitting).'''
+        if self.split:
+            self.filenames.append(_save_simulation(simulation, self.doc, self._cache, self.outputFileDir))
+        elif self.stream:
+            self._writer.send(simulation)
+        else:
+            return
+        self.doc.remove(simulation)
+    
+    def add_xml(self, xml):
+        '''Adds a serialized simulation (see SimulationTemplate) to doc.'''
+        if self.stream and not self.split:
+            self._writer.send(xml)
+        else:
+            simulation = ET.fromstring(xml, _blankTextParser)
+            self.doc.append(simulation)
+            self.add(simulation)
+    
+    def close(self):
+        '''
+        Finishes saving the document.
+        
+        Returns
+        -------
+        Name of the .apsim file saved, or the list of names if splitting.
+        '''
+        if self.split:
+            return self.filenames
+        elif self.stream:
+            self._writer.close()
+            self._file.close()
+            return self.filename
+        else:
+            return save_file(self.doc, self.filename, self.outputFileDir)
@@ -3,13 +3,106 @@
 #==============================================================================
 #     Main program for creating all apsim files and batch script
 #==============================================================================
-import glob, os
+import glob, os, json, hashlib
+from time import time
+from itertools import imap
+import multiprocessing as mp
 from apsimconfig import new_apsim
-import fileio, batch
+import fileio, batch, soils, gridlut
 
-def _create_apsim_file(runDir, dataPath, config):
-    ''' Creates .apsim and associated files.'''
-    # remove old .apsim files
+# record of the inputs of the .apsim files in a data directory
+FINGERPRINT_FILENAME = 'preprocess.fingerprint'
+
+# md5 of the source of this package, see _get_package_hash
+_packageHash = []
+
+def _get_package_hash():
+    '''md5 of the source of the preprocess package, so .apsim files are
+    created again when the code that creates them changes.'''
+    if _packageHash == []:
+        packageDir = os.path.dirname(os.path.abspath(__file__))
+        md5 = hashlib.md5()
+        for sourcePath in sorted(glob.glob(os.path.join(packageDir, '*.py'))):
+            md5.update(fileio.get_file_hash(sourcePath))
+        _packageHash.append(md5.hexdigest())
+    return _packageHash[0]
+
+def get_input_fingerprint(configPath, config):
+    '''
+    Fingerprint of everything the .apsim files of a run are made from.
+    
+    The met files are not included, as .apsim files only hold their paths,
+    nor are the runtimes used to balance shards, as shards made from older
+    runtimes are still valid.
+    
+    Returns
+    -------
+    Dictionary of the md5 of config.ini, the lookup table, the soils file
+    and the preprocess package.
+    '''
+    return {'config':fileio.get_file_hash(configPath),
+            'gridLut':fileio.get_file_hash(config.gridLutPath),
+            'soils':fileio.get_file_hash(config.soilDataPath),
+            'package':_get_package_hash()}
+
+def _get_file_stat(path):
+    '''(size, mtime) of a file.'''
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+def _is_up_to_date(dataPath, fingerprint):
+    ''' Checks if the .apsim files in dataPath were made from inputs with
+    the same fingerprint, and have not been changed or removed since.'''
+    fingerprintPath = os.path.join(dataPath, FINGERPRINT_FILENAME)
+    if not os.path.isfile(fingerprintPath):
+        return False
+    try:
+        with open(fingerprintPath, 'r') as f:
+            saved = json.load(f)
+    except ValueError:
+        return False
+    if saved.get('inputs') != fingerprint:
+        return False
+    apsimFiles = saved.get('apsimFiles', {})
+    if sorted(apsimFiles) != sorted(os.path.basename(path) for path in glob.glob(os.path.join(dataPath, '*.apsim'))):
+        return False
+    for filename, stat in apsimFiles.iteritems():
+        if _get_file_stat(os.path.join(dataPath, filename)) != stat:
+            return False
+    return True
+
+def _save_fingerprint(dataPath, fingerprint):
+    '''Saves the fingerprint of the inputs and the (size, mtime) of the
+    .apsim files in dataPath.'''
+    apsimFiles = dict((os.path.basename(path), _get_file_stat(path)) for path in glob.glob(os.path.join(dataPath, '*.apsim')))
+    with open(os.path.join(dataPath, FINGERPRINT_FILENAME), 'w') as f:
+        json.dump({'inputs':fingerprint, 'apsimFiles':apsimFiles}, f, indent=1, sort_keys=True)
+
+def _create_apsim_file(runDir, dataPath, config, configPath, force=False):
+    '''
+    Creates .apsim and associated files, unless the .apsim files in
+    dataPath were made from the same inputs (see get_input_fingerprint).
+    
+    Files that are not created again keep their contents, so ApsimRun's
+    run manifest, which records the md5 of each converted .apsim file,
+    still finds the .sim files and outputs made from them valid and does
+    not convert or run them again.
+    
+    Returns
+    -------
+    True if .apsim files were created, False if they were up to date.
+    '''
+    # create batch file
+    batch.create_run_batchfile(runDir, config.apsimModelDir)
+    
+    fingerprint = get_input_fingerprint(configPath, config)
+    if not force and _is_up_to_date(dataPath, fingerprint):
+        return False
+    
+    # remove old .apsim files and fingerprint
+    fingerprintPath = os.path.join(dataPath, FINGERPRINT_FILENAME)
+    if os.path.isfile(fingerprintPath):
+        os.remove(fingerprintPath)
     apsimFileList = glob.glob(os.path.join(dataPath,'*.apsim'))
     for apsimFile in apsimFileList:
         os.remove(apsimFile)
@@ -17,10 +110,10 @@ def _create_apsim_file(runDir, dataPath, config):
     # create .apsim file
     new_apsim(dataPath, config)
     
-    # create batch file
-    batch.create_run_batchfile(runDir, config.apsimModelDir)
+    _save_fingerprint(dataPath, fingerprint)
+    return True
     
-def preprocess_one(configPath):
+def preprocess_one(configPath, force=False):
     '''
     Preprocesses one APSIM file.
     
@@ -28,10 +121,14 @@ def preprocess_one(configPath):
     ----------
     configPath : string
         path to where config file is located
+    force : bool
+        (optional) create the .apsim files even if their inputs have not
+        changed
         
     Returns
     -------
-    Saves a .apsim file based on config.ini settings
+    Saves a .apsim file based on config.ini settings. Returns True if it
+    was saved, False if it was up to date.
     '''
     
     # read configuration file
@@ -50,9 +147,43 @@ def preprocess_one(configPath):
         os.mkdir(dataPath)
     
     # Create .apsim file
-    _create_apsim_file(runDir, dataPath, config)
+    return _create_apsim_file(runDir, dataPath, config, configPath, force)
+
+def _preprocess_run(args):
+    '''
+    Preprocesses one run, in a worker process of preprocess_many.
+    
+    Parameters
+    ----------
+    args : tuple
+        configPath and force arguments of preprocess_one
+    
+    Returns
+    -------
+    configPath, runtime (s), whether .apsim files were created and error
+    message (None if it succeeded).
+    '''
+    configPath, force = args
+    timeOld = time()
+    created = False
+    try:
+        created = preprocess_one(configPath, force)
+        error = None
+    except Exception as e:
+        error = '{0}: {1}'.format(type(e).__name__, e)
+    return configPath, time() - timeOld, created, error
+
+def _load_shared_inputs(configPaths):
+    ''' Loads the soils files and lookup tables of the runs, so they are
+    parsed once: worker processes get them from the on-disk caches (or
+    inherit them when forked) instead of each parsing them again.'''
+    for configPath in configPaths:
+        if os.path.isfile(configPath):
+            config = fileio.Config(configPath)
+            soils.load_library(config.soilDataPath)
+            gridlut.load_grid_lut(config.gridLutPath)
 
-def preprocess_many(outputDir, startRun, endRun=None):
+def preprocess_many(outputDir, startRun, endRun=None, numCPU=1, force=False):
     '''
     Sets which runs to preprocess.
     
@@ -65,20 +196,55 @@ def preprocess_many(outputDir, startRun, endRun=None):
     endRun : int
         (optional) run number to stop on. Should correspond to a folder number.
         If not provided, will only process run startRun.
+    numCPU : int
+        (optional) number of processes to preprocess runs with. Runs are
+        independent, so they are preprocessed at the same time.
+    force : bool
+        (optional) create the .apsim files of every run, even those whose
+        inputs have not changed since they were created
         
     Returns
     -------
-    Nothing.
+    List of the config.ini paths of runs that failed.
     '''
     
     # set runs to process
     if endRun == None:
         endRun = startRun # inclusive
     runs = range(startRun, endRun+1)
+    configPaths = [os.path.join(outputDir, str(run), 'config.ini') for run in runs]
+    
+    _load_shared_inputs(configPaths)
+    
+    numCPU = min(numCPU, len(configPaths))
+    if numCPU > 1:
+        pool = mp.Pool(numCPU)
+        results = pool.imap_unordered(_preprocess_run, [(configPath, force) for configPath in configPaths])
+    else:
+        pool = None
+        results = imap(_preprocess_run, [(configPath, force) for configPath in configPaths])
+    
+    timeOld = time()
+    failed = []
+    numUpToDate = 0
+    for numDone, (configPath, runtime, created, error) in enumerate(results, 1):
+        runDir = os.path.basename(os.path.dirname(configPath))
+        if error != None:
+            print '*** Warning: run {0} failed ({1})'.format(runDir, error)
+            failed.append(configPath)
+        if error == None and not created:
+            numUpToDate += 1
+            status = 'up to date'
+        else:
+            status = '{0:.1f} s'.format(runtime)
+        print 'Run {0} ({1}/{2}) - {3}% - {4}'.format(runDir, numDone, len(configPaths), numDone * 100 / len(configPaths), status)
+    
+    if pool != None:
+        pool.close()
+        pool.join()
+    print 'Preprocessed {0} runs in {1:.1f} s ({2} up to date)'.format(len(configPaths), time() - timeOld, numUpToDate)
     
-    for run in runs:
-        configPath = os.path.join(outputDir, str(run), 'config.ini')
-        preprocess_one(configPath)
+    return failed
         
 # Run main() if module is run as a program
 if __name__ == '__main__':
@@ -91,9 +257,13 @@ if __name__ == '__main__':
     
     startRun = 1
     endRun = None
+    numCPU = mp.cpu_count()
     
     print 'Saving .apsim and .bat files...'
-    preprocess_many(outputDir, startRun, endRun)
+    failed = preprocess_many(outputDir, startRun, endRun, numCPU)
+    if failed != []:
+        print '*** Error: {0} runs failed.'.format(len(failed))
+        raise SystemExit(1)
     
     print '\n***** Done! *****'
     
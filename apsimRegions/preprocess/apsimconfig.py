@@ -4,11 +4,48 @@
 #     Configuration for setting APSIM run parameters and structure
 #==============================================================================
 
-import os, posixpath
-from pandas import read_csv, DateOffset
+import os, posixpath, heapq
+import sqlite3 as lite
+from pandas import DateOffset
 from datetime import datetime
-import apsim, soils
+from time import time
+import apsim, soils, gridlut
 import managementRules as manager
+
+# end crop date of each sowing date, see get_end_date
+_endDates = {}
+
+class StepTimer:
+    '''
+    Adds up the time spent in each step of creating .apsim files.
+    
+    Call lap(step) at the end of each step: the time since the last lap
+    (or since the timer was created) is added to step.
+    
+    Attributes
+    ----------
+    times : dictionary
+        'step':seconds mapping
+    counts : dictionary
+        'step':number of laps mapping
+    '''
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self._last = time()
+    
+    def lap(self, step):
+        '''Adds the time since the last lap to step.'''
+        now = time()
+        self.times[step] = self.times.get(step, 0.) + now - self._last
+        self.counts[step] = self.counts.get(step, 0) + 1
+        self._last = now
+    
+    def report(self, numPoints):
+        '''Prints the time of each step, in total and per grid point.'''
+        total = sum(self.times.values())
+        for step in sorted(self.times, key=self.times.get, reverse=True):
+            print '    {0:20} : {1:7.3f} s {2:5.1%} {3:8.1f} us/point ({4} laps)'.format(step, self.times[step], self.times[step] / total, self.times[step] / numPoints * 1e6, self.counts[step])
     
 def setup_project(projectName):
     '''Sets up project options for all simulations.'''
@@ -23,14 +60,16 @@ def setup_met(met, metFileDir, gridpoint):
     met_path = posixpath.join(metFileDir,met+'_'+str(gridpoint).zfill(5)+'.met')
     return met_path
 
-def setup_soils(element, soilDataPath):
-    '''Sets up soils for all simulations.'''
-    soilsDir = os.path.dirname(soilDataPath)
-    soilDataFilename = os.path.basename(soilDataPath)
-    origDir = os.getcwd()
-    os.chdir(soilsDir)
-    soils.add_soils(element, soilDataFilename)
-    os.chdir(origDir)
+def setup_soils(element, soilDataPath, soilNames=None):
+    '''Sets up soils for all simulations: the soils in soilNames, or all soils
+    if not provided. The soils file is only parsed the first time (see
+    soils.load_library).'''
+    library = soils.load_library(soilDataPath)
+    if soilNames != None:
+        missing = sorted(set(soilNames) - set(library.names))
+        if missing != []:
+            print '*** Warning: soils {0} are not in {1}'.format(', '.join(missing), soilDataPath)
+    library.add_soils(element, soilNames)
     
 def setup_shared_management_options(folder, crop, config, shortcut=None):
     '''Sets up management options for all simulations.'''
@@ -72,31 +111,59 @@ def setup_shared_management_options(folder, crop, config, shortcut=None):
                      (harvestRule.get('name'),'manager')]            
     return rulesList
     
-def setup_management_options(folder, crop, config, gridpoint, gridLut, shortcut, rulesList, soil):
+def get_sow_dates(config, gridpoint, gridLut):
     '''
-    Setup management rules based on grid cell.
+    Sowing dates of a grid cell.
     
-    REMEMBER: order matters!
+    Returns
+    -------
+    Start and end (dd-mmm, end is '' to sow on the start date) of the
+    sowing window, and the date (dd-mmm) to end any crop left in the
+    ground, 2 days before the sowing window starts.
     '''
-    # reset water, nitrogen, and surfaceOM rule
-    #manager.reset_on_sowing(folder, crop, soilmodule=soil.get('name'))
-    
     # set dates from config file
     sowStart = config.sowStart
     sowEnd = config.sowEnd
     
     # if sowStart is 'auto', set by location from provided lookup table
     if sowStart == 'auto':
-        sowStart = gridLut['sow_start'][gridpoint]
+        sowStart = gridLut.lookup('sow_start')[gridpoint]
     
     # if sowEnd is 'auto', set by location from provided lookup table
     if sowEnd == 'auto':
-        sowEnd = gridLut['sow_end'][gridpoint]
+        sowEnd = gridLut.lookup('sow_end')[gridpoint]
+    
+    return sowStart, sowEnd, get_end_date(sowStart)
+
+def get_end_date(sowStart):
+    '''Date (dd-mmm) to end any crop that may be left in the ground, 2 days
+    before sowStart (dd-mmm). Worked out once for each sowing date, as a few
+    dates are shared by all the grid cells.'''
+    if sowStart not in _endDates:
+        endDate = datetime.strptime(sowStart, '%d-%b') - DateOffset(2)
+        _endDates[sowStart] = datetime.strftime(endDate, '%d-%b')
+    return _endDates[sowStart]
+
+def setup_management_options(folder, crop, config, gridpoint, gridLut, shortcut, rulesList, soil):
+    '''
+    Setup management rules based on grid cell.
+    
+    REMEMBER: order matters!
+    '''
+    # reset water, nitrogen, and surfaceOM rule
+    #manager.reset_on_sowing(folder, crop, soilmodule=soil.get('name'))
     
+    sowStart, sowEnd, endDate = get_sow_dates(config, gridpoint, gridLut)
+    add_management_rules(folder, crop, config, sowStart, sowEnd, endDate, shortcut, rulesList)
+
+def add_management_rules(folder, crop, config, sowStart, sowEnd, endDate, shortcut, rulesList):
+    '''
+    Adds the management rules of a grid cell, given its sowing dates (see
+    get_sow_dates).
+    
+    REMEMBER: order matters!
+    '''
     # end crop on fixed date rule
-    # removes any crop that may be left in the groud 2 days before sowing
-    endDate = datetime.strptime(sowStart, '%d-%b') - DateOffset(2)
-    endDate = datetime.strftime(endDate, '%d-%b')
     manager.end_crop_on_fixed_date_rule(folder, crop, endDate)
         
     if crop == 'maize':
@@ -141,15 +208,75 @@ def _new_shortcut(project, simulation, subfolder=''):
     fullpath = '/' + project + '/' + simulation + '/' + subfolder
     return fullpath
     
-def select_soil(gridpoint, crop, element, shortcutroot, soilLut, soilName):
-    ''' Chooses soil to use based on grid cell.'''
+def get_soil_name(gridpoint, soilLut, soilName):
+    '''Name of the soil of a grid cell: from the soil code in the lookup
+    table if soilName is 'auto', else soilName.'''
     if soilName == 'auto':
         soilName = 'HCGEN' + str(soilLut[gridpoint]).zfill(4)
+    return soilName
+
+def get_soil_names(gridLut, soilName):
+    '''Set of the soils used by the grid cells of gridLut.'''
+    if soilName == 'auto':
+        soilLut = gridLut.lookup('soil_code')
+        return set(get_soil_name(gridpoint, soilLut, soilName) for gridpoint in gridLut.index)
+    return set([soilName])
+
+def select_soil(gridpoint, crop, element, shortcutroot, soilLut, soilName):
+    ''' Chooses soil to use based on grid cell.'''
+    soilName = get_soil_name(gridpoint, soilLut, soilName)
     shortcut = shortcutroot + soilName
     soil = apsim.new_soil(element, crop, soilName, shortcut)
     return soil
 
-def new_apsim(outputFileDir, config):
+def _get_point_costs(historyPath):
+    '''Average runtime (s) of each grid point in the runtime history saved
+    by ApsimRun, or an empty dictionary if there is none.'''
+    if not os.path.isfile(historyPath):
+        return {}
+    con = lite.connect(historyPath)
+    try:
+        costs = dict(con.execute("SELECT point_id, AVG(wall_time) FROM runtimes GROUP BY point_id"))
+    except lite.OperationalError:
+        costs = {}
+    con.close()
+    return costs
+
+def shard_points(gridpointList, costs, numShards):
+    '''
+    Splits grid points into shards of about the same total cost, giving
+    each point (most costly first) to the shard with the least cost so far.
+    
+    Parameters
+    ----------
+    gridpointList : list
+        grid points to split
+    costs : dictionary
+        gridpoint:cost mapping, ie runtimes. Points that are missing cost
+        the average of the others (1 if costs is empty).
+    numShards : int
+        number of shards
+    
+    Returns
+    -------
+    List of shards, each a list of grid points in their original order.
+    '''
+    known = [costs[gridpoint] for gridpoint in gridpointList if gridpoint in costs]
+    if known != []:
+        defaultCost = sum(known) / len(known)
+    else:
+        defaultCost = 1.
+    
+    order = sorted(range(len(gridpointList)), key=lambda i: -costs.get(gridpointList[i], defaultCost))
+    heap = [(0., shard) for shard in range(numShards)]
+    shardIndices = [[] for shard in range(numShards)]
+    for i in order:
+        cost, shard = heapq.heappop(heap)
+        shardIndices[shard].append(i)
+        heapq.heappush(heap, (cost + costs.get(gridpointList[i], defaultCost), shard))
+    return [[gridpointList[i] for i in sorted(indices)] for indices in shardIndices if indices != []]
+
+def new_apsim(outputFileDir, config, timer=None):
     '''
     Creates a new apsim file in directory outputFileDir writing
     the metFileDir to each file.
@@ -160,11 +287,60 @@ def new_apsim(outputFileDir, config):
         path to save .apsim files to
     config : Config object from fileio module
         configuration settings for the run.
+    timer : StepTimer
+        (optional) adds up the time spent in each step, ie to see where
+        the time goes for large grids (see StepTimer.report)
         
     Returns
     -------
-    Name of the .apsim file which was saved to specified directory
+    Name of the .apsim file which was saved to specified directory, or a
+    list of names if config.numShards is more than 1 or
+    config.splitSimulations is 'yes'
+    
+    If config.numShards is more than 1, the grid points are split into
+    that many .apsim files (ie NARR32_maize_shard01.apsim), each with its
+    own shared soils, rules and base simulation, so they can be converted
+    and run in parallel. Shards are balanced by the runtimes ApsimRun saved
+    for the experiment (apsimRuntimes.sqlite) if there are any, else by
+    number of grid points.
+    
+    If config.streamSimulations is 'yes', each simulation is written to the
+    file as soon as it is created, so memory use stays the same however
+    many grid points there are.
+    
+    Only the soils used by the grid points of a file are added to its
+    shared soils folder.
     '''
+    if timer == None:
+        timer = StepTimer()
+    
+    # read grid lookup table
+    gridLut = gridlut.load_grid_lut(config.gridLutPath)
+    timer.lap('lookup table')
+    
+    projectName = config.met + '_' + config.crop
+    numShards = min(config.numShards, len(gridLut))
+    if numShards <= 1:
+        return _new_apsim(outputFileDir, config, gridLut, projectName + '.apsim', timer)
+    
+    # runs made by preprocess.py are in output/<experiment>/<run>/data and
+    # ApsimRun saves runtimes to output/<experiment>/apsimRuntimes.sqlite
+    historyPath = os.path.join(outputFileDir, os.pardir, os.pardir, 'apsimRuntimes.sqlite')
+    shards = shard_points(list(gridLut.index), _get_point_costs(historyPath), numShards)
+    timer.lap('sharding')
+    apsimFilenames = []
+    for shard, gridpointList in enumerate(shards):
+        filename = '{0}_shard{1:02d}.apsim'.format(projectName, shard + 1)
+        apsimFilename = _new_apsim(outputFileDir, config, gridLut.select(gridpointList), filename, timer)
+        if isinstance(apsimFilename, list):
+            apsimFilenames += apsimFilename
+        else:
+            apsimFilenames.append(apsimFilename)
+    return apsimFilenames
+
+def _new_apsim(outputFileDir, config, gridLut, filename, timer):
+    '''Creates an .apsim file for the grid points of gridLut (see
+    new_apsim).'''
     # set variables from config
     met = config.met
     crop = config.crop
@@ -172,15 +348,13 @@ def new_apsim(outputFileDir, config):
                                          # soil folder
     metFileDir = config.metFileDir
     
-    # read grid lookup table
-    gridLut = read_csv(config.gridLutPath, index_col='point_id')
-    
     # begin creating .apsim xml
     projectName = met + '_' + crop
     doc = setup_project(projectName)
     soilfolder_name = 'Shared Soils'
     soilfolder = apsim.new_folder(doc, soilfolder_name)
-    setup_soils(soilfolder, soilDataPath)
+    setup_soils(soilfolder, soilDataPath, get_soil_names(gridLut, config.soilName))
+    timer.lap('soils')
     managerSharedFolderName = 'Shared Management Rules'
     managerSharedFolder = apsim.new_folder(doc,managerSharedFolderName)
     rulesList = setup_shared_management_options(managerSharedFolder, crop, config)
@@ -210,7 +384,7 @@ def new_apsim(outputFileDir, config):
     # soil
     soil = select_soil(gridpoint, crop, paddock_base,
                 _new_shortcut(projectName, soilfolder.get('name')),\
-                gridLut['soil_code'], config.soilName)
+                gridLut.lookup('soil_code'), config.soilName)
     
     # surface organic matter
     surfaceom_base = apsim.new_surfaceom(paddock_base, crop, 
@@ -254,58 +428,92 @@ def new_apsim(outputFileDir, config):
     
     # graph
     #setup_graph_options(paddock_base)
+    
+    # everything else has shortcuts to the shared folders and base
+    # simulation, which stay in doc while the other simulations are saved
+    writer = apsim.SimulationWriter(doc, filename, outputFileDir,
+                                    stream=config.streamSimulations == 'yes',
+                                    split=config.splitSimulations == 'yes')
+    timer.lap('base simulation')
 
     # ----------------------------------------------
     # Add simulations for the rest of the grid cells
     # ----------------------------------------------
+    # the simulations only differ in a few values, so each is made by
+    # filling in a template built once (one for sowing on a fixed date and
+    # one for sowing windows, as they have different sowing rules)
+    field = apsim.template_field
+    templates = {}
+    soilLut = gridLut.lookup('soil_code')
     for gridpoint in gridpointList[1:]:
-        simName = projectName + '_' + str(gridpoint).zfill(5)
-        simulation = apsim.new_simulation(doc, simName)
-        
-        # met
-        met_path = setup_met(met, metFileDir, gridpoint)
-        apsim.new_metfile(simulation, met_path)
-        
-        # clock
-        apsim.new_clock(simulation, shortcut=_new_shortcut(projectName,simName_base))
-        
-        # summary file
-        apsim.new_summaryfile(simulation, simName + '.sum', _new_shortcut(projectName,simName_base))
-        
-        # paddock
-        paddock = apsim.new_area(simulation, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
-        
-        # soil
-        soil = select_soil(gridpoint, crop, paddock, _new_shortcut(projectName, soilfolder_name), gridLut['soil_code'], config.soilName)
-        
-        # surface organic matter
-        apsim.new_surfaceom(paddock, crop, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name+'/'+surfaceom_base_name))
-        
-        # irrigation
-        apsim.new_irrigation(paddock,shortcut=_new_shortcut(projectName,simName_base,paddock_base_name+'/'+irrigation_base_name))
-        
-        # fertiliser
-        apsim.new_fertiliser(paddock, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
-        
-        # crop
-        apsim.new_crop(paddock, crop, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
-        
-        # management rules
-        managerFolderName = 'Management Rules'
-        managerFolder = apsim.new_folder(paddock,managerFolderName) 
-        setup_management_options(managerFolder, crop, config, gridpoint, gridLut,\
+        sowStart, sowEnd, endDate = get_sow_dates(config, gridpoint, gridLut)
+        timer.lap('sowing dates')
+        fixedDate = sowEnd == ''
+        if fixedDate not in templates:
+            simulation = apsim.new_simulation(apsim.new_document(), field('simName'))
+            
+            # met
+            apsim.new_metfile(simulation, field('metPath'))
+            
+            # clock
+            apsim.new_clock(simulation, shortcut=_new_shortcut(projectName,simName_base))
+            
+            # summary file
+            apsim.new_summaryfile(simulation, field('simName') + '.sum', _new_shortcut(projectName,simName_base))
+            
+            # paddock
+            paddock = apsim.new_area(simulation, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
+            
+            # soil
+            apsim.new_soil(paddock, crop, field('soilName'), _new_shortcut(projectName, soilfolder_name) + field('soilName'))
+            
+            # surface organic matter
+            apsim.new_surfaceom(paddock, crop, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name+'/'+surfaceom_base_name))
+            
+            # irrigation
+            apsim.new_irrigation(paddock,shortcut=_new_shortcut(projectName,simName_base,paddock_base_name+'/'+irrigation_base_name))
+            
+            # fertiliser
+            apsim.new_fertiliser(paddock, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
+            
+            # crop
+            apsim.new_crop(paddock, crop, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
+            
+            # management rules
+            managerFolderName = 'Management Rules'
+            managerFolder = apsim.new_folder(paddock,managerFolderName)
+            if fixedDate:
+                sowEndField = ''
+            else:
+                sowEndField = field('sowEnd')
+            add_management_rules(managerFolder, crop, config, field('sowStart'), sowEndField, field('endDate'),\
                                  _new_shortcut(projectName,managerSharedFolder.get('name')),\
-                                rulesList, soil)
-        
-        # output
-        apsim.new_outputfile(paddock, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
-        
-        # tracker
-        apsim.new_tracker(paddock, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
+                                 rulesList)
+            
+            # output
+            apsim.new_outputfile(paddock, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
+            
+            # tracker
+            apsim.new_tracker(paddock, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
+            
+            # graph
+            #apsim.new_graph(paddock, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
+            
+            templates[fixedDate] = apsim.SimulationTemplate(simulation)
+            timer.lap('templates')
         
-        # graph
-        #apsim.new_graph(paddock, shortcut=_new_shortcut(projectName,simName_base,paddock_base_name))
+        values = {'simName':projectName + '_' + str(gridpoint).zfill(5),
+                  'metPath':setup_met(met, metFileDir, gridpoint),
+                  'soilName':get_soil_name(gridpoint, soilLut, config.soilName),
+                  'sowStart':sowStart,
+                  'sowEnd':sowEnd,
+                  'endDate':endDate}
+        xml = templates[fixedDate].fill(values)
+        timer.lap('fill template')
+        writer.add_xml(xml)
+        timer.lap('write')
         
-    apsimFilename = apsim.save_file(doc, projectName + '.apsim', outputFileDir)
+    apsimFilename = writer.close()
+    timer.lap('write')
     
     return apsimFilename
\ No newline at end of file
@@ -74,7 +74,8 @@ def create_config_file(configPath, gridLutPath, metFileDir, \
                         asw_depth='600', crit_fr_asw='0.95', irrigation_efficiency='1',\
                         irrigation_allocation='off', allocation='0',\
                         density='8', depth='30', cultivar='usa_18leaf', row_spacing='760',\
-                        outputVariables='mm/dd/yyyy as date, yield, biomass, lai, rain, mint, maxt, radn, irr_fasw'):
+                        outputVariables='mm/dd/yyyy as date, yield, biomass, lai, rain, mint, maxt, radn, irr_fasw',
+                        splitSimulations='no', streamSimulations='no', numShards='1'):
     '''
     Saves an apsimRegions configuration file.
     
@@ -135,6 +136,13 @@ def create_config_file(configPath, gridLutPath, metFileDir, \
         (optional) spacing of rows in mm
     outputVariables : string
         (optional) APSIM variables to output, separated by commas
+    splitSimulations : string
+        (optional) if 'yes', save each grid point to its own .apsim file
+    streamSimulations : string
+        (optional) if 'yes', write each simulation to the .apsim file as it
+        is created instead of keeping all of them in memory
+    numShards : int or string
+        (optional) number of .apsim files to split the grid points into
         
     Returns
     -------
@@ -216,6 +224,11 @@ def create_config_file(configPath, gridLutPath, metFileDir, \
     # tracker settings
     config.set(pre, 'trackerVariables', '')
     
+    # .apsim file settings
+    config.set(pre, 'splitSimulations', splitSimulations)
+    config.set(pre, 'streamSimulations', streamSimulations)
+    config.set(pre, 'numShards', str(numShards))
+    
     # -------------
     # postprocessor
     # -------------
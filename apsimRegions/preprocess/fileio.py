@@ -4,8 +4,51 @@
 # File input/output operations
 #==============================================================================
 
+import os, stat, tempfile, hashlib
 import ConfigParser as configparser
 
+def get_file_hash(path, blocksize=2**20):
+    '''md5 of a file, read blocksize bytes at a time.'''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def get_cache_dir():
+    '''
+    Directory where parsed input files (soils, lookup tables) are cached.
+    
+    The directory belongs to the current user: %LOCALAPPDATA%\\apsimRegions
+    on Windows, and $XDG_CACHE_HOME/apsimRegions (~/.cache/apsimRegions)
+    elsewhere. It is created readable and writable by its owner only.
+    
+    Returns
+    -------
+    Path of the cache directory, or None (nothing is cached) if it can't be
+    created or could have been written by another user.
+    '''
+    if os.name == 'nt':
+        baseDir = os.environ.get('LOCALAPPDATA', tempfile.gettempdir())
+    else:
+        baseDir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    cacheDir = os.path.join(baseDir, 'apsimRegions')
+    
+    try:
+        os.makedirs(cacheDir, 0700)
+    except OSError:
+        # already exists, or can't be created
+        pass
+    try:
+        cacheStat = os.lstat(cacheDir)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(cacheStat.st_mode):
+        return None
+    if hasattr(os, 'getuid') and (cacheStat.st_uid != os.getuid() or cacheStat.st_mode & 022):
+        return None
+    return cacheDir
+
 def _clean(variables):
     '''
     Removes new line (\\n), return (\\r), tabs (\\t), and whitespace from variables.
@@ -112,6 +155,17 @@ class Config:
             # tracker settings
             self.trackerVariables = _clean(parser.get(section, 'trackerVariables').split(','))
             
+            # .apsim file settings (optional, not in older config files)
+            self.splitSimulations = 'no'
+            if parser.has_option(section, 'splitSimulations'):
+                self.splitSimulations = parser.get(section, 'splitSimulations')
+            self.streamSimulations = 'no'
+            if parser.has_option(section, 'streamSimulations'):
+                self.streamSimulations = parser.get(section, 'streamSimulations')
+            self.numShards = 1
+            if parser.has_option(section, 'numShards'):
+                self.numShards = parser.getint(section, 'numShards')
+            
         else:
             print '*** Warning: section "{0}" does not exist'.format(section)
     
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#     Grid lookup table (point_id, lat, lon, soil_code, sow_start, etc.),
+#     read once and cached
+#==============================================================================
+
+import os, hashlib
+import numpy as np
+from pandas import read_csv, DataFrame, isnull
+import fileio
+
+# lookup tables already loaded by this process, by path, size and mtime
+_tables = {}
+
+class GridLut:
+    '''
+    Grid lookup table stored as one numpy array per column.
+
+    Attributes
+    ----------
+    path : string
+        csv file the table was read from
+    columns : list
+        column names, in the order of the csv file
+    index : list
+        point_id of each row
+    '''
+    def __init__(self, path, columns, data):
+        self.path = path
+        self.columns = columns
+        self._data = data
+        self.index = data['point_id'].tolist()
+        self._rows = dict((pointId, row) for row, pointId in enumerate(self.index))
+        self._lookups = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, name):
+        '''Column name as a numpy array.'''
+        return self._data[name]
+
+    def lookup(self, name):
+        '''point_id:value mapping of column name, for fast lookups one grid
+        point at a time.'''
+        if name not in self._lookups:
+            self._lookups[name] = dict(zip(self.index, self._data[name].tolist()))
+        return self._lookups[name]
+
+    def get_rows(self, pointIds):
+        '''Row numbers of grid points.'''
+        return np.array([self._rows[pointId] for pointId in pointIds], dtype=int)
+
+    def select(self, pointIds):
+        '''New GridLut of the rows of grid points pointIds, in that order.'''
+        rows = self.get_rows(pointIds)
+        return GridLut(self.path, self.columns, dict((name, column[rows]) for name, column in self._data.iteritems()))
+
+    def to_dataframe(self):
+        '''The table as a pandas dataframe.'''
+        return DataFrame(self._data, columns=self.columns)
+
+def _read_csv(path):
+    '''Column names and {name:array} of the columns of a csv file.'''
+    table = read_csv(path)
+    columns = list(table.columns)
+    return columns, dict((name, table[name].values) for name in columns)
+
+def _save_cache(cachePath, columns, data):
+    '''
+    Saves columns to an .npz file. Writes to a temporary file first so
+    other processes never read a partial cache.
+    
+    Text columns are saved as fixed width strings, with a mask of their
+    missing values, so the cache holds no pickled objects and is loaded
+    with allow_pickle=False. Tables with other object columns (ie mixed
+    types) are not cached.
+    
+    Returns
+    -------
+    True if the cache was saved.
+    '''
+    arrays = {'columns':np.array(columns)}
+    for n, name in enumerate(columns):
+        column = data[name]
+        if column.dtype == object:
+            missing = isnull(column)
+            values = column[~missing].tolist()
+            if all(isinstance(value, str) for value in values):
+                textType = str
+            elif all(isinstance(value, unicode) for value in values):
+                textType = unicode
+            else:
+                return False
+            column = column.copy()
+            column[missing] = ''
+            column = column.astype(textType)
+            arrays['missing{0}'.format(n)] = missing
+        arrays['column{0}'.format(n)] = column
+    
+    tmpPath = '{0}.{1}.tmp'.format(cachePath, os.getpid())
+    with open(tmpPath, 'wb') as f:
+        np.savez(f, **arrays)
+    if not os.path.isfile(cachePath):
+        os.rename(tmpPath, cachePath)
+    else:
+        os.remove(tmpPath)
+    return True
+
+def _load_cache(cachePath):
+    '''Column names and {name:array} of the columns saved by _save_cache.'''
+    data = {}
+    with np.load(cachePath, allow_pickle=False) as arrays:
+        columns = arrays['columns'].tolist()
+        for n, name in enumerate(columns):
+            column = arrays['column{0}'.format(n)]
+            if 'missing{0}'.format(n) in arrays.files:
+                column = column.astype(object)
+                column[arrays['missing{0}'.format(n)]] = np.nan
+            data[name] = column
+    return columns, data
+
+def load_grid_lut(path, cacheDir=None):
+    '''
+    Reads a grid lookup table once: later calls for the same file, while
+    its size and modification time are unchanged, use the table already
+    loaded by this process, or else the one cached on disk by an earlier
+    process.
+
+    Parameters
+    ----------
+    path : string
+        csv file of the grid lookup table, with a point_id column
+    cacheDir : string
+        (optional) directory of the on-disk cache (see
+        fileio.get_cache_dir)
+
+    Returns
+    -------
+    GridLut of path.
+    '''
+    stat = os.stat(path)
+    key = hashlib.md5('{0}|{1}|{2!r}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime)).hexdigest()
+    if key in _tables:
+        return _tables[key]
+
+    if cacheDir == None:
+        cacheDir = fileio.get_cache_dir()
+    columns = None
+    if cacheDir != None:
+        cachePath = os.path.join(cacheDir, key + '.gridlut.npz')
+        if os.path.isfile(cachePath):
+            try:
+                columns, data = _load_cache(cachePath)
+            except (IOError, ValueError, KeyError):
+                columns = None
+    if columns == None:
+        columns, data = _read_csv(path)
+        if cacheDir != None:
+            try:
+                if not os.path.isdir(cacheDir):
+                    os.makedirs(cacheDir)
+                _save_cache(cachePath, columns, data)
+            except (IOError, OSError):
+                # the cache is only an optimization
+                pass
+
+    gridLut = GridLut(path, columns, data)
+    _tables[key] = gridLut
+    return gridLut
@@ -3,24 +3,149 @@
 #     Module for parsing soil files
 #==============================================================================
 
+import os, json, hashlib
 import lxml.etree as ET
+import fileio
+
+# soil libraries already loaded by this process, by soils file path, size and
+# modification time
+_libraries = {}
+
+class SoilLibrary:
+    '''
+    Soils of a soils file, each kept as serialized XML so that a document
+    gets its own copy of a soil without the file being parsed again.
+
+    Attributes
+    ----------
+    filename : string
+        soils file the library was read from
+    md5 : string
+        md5 of the soils file
+    names : list
+        soil names, in the order of the soils file
+    soils : dictionary
+        'name':'xml' mapping of serialized soils
+    '''
+    def __init__(self, filename, md5, soilList):
+        self.filename = filename
+        self.md5 = md5
+        self.names = [name for name, xml in soilList]
+        self.soils = dict(soilList)
+
+    def get_soil(self, name):
+        '''New lxml element of soil name.'''
+        return ET.fromstring(self.soils[name])
+
+    def add_soils(self, element, names=None):
+        ''' Adds copies of soils to element.
+
+        Parameters
+        ----------
+        element : lxml element tree element
+            element to add soils to
+        names : list
+            (optional) names of the soils to add, all soils if not provided.
+            Soils are added in the order of the soils file.
+
+        Returns
+        -------
+        Nothing
+        '''
+        for name in self.names:
+            if names == None or name in names:
+                element.append(self.get_soil(name))
+
+def _parse_soils(filename):
+    '''List of (name, xml) of each soil in filename.'''
+    soiltree = ET.parse(filename).getroot()
+    return [(soil.get('name'), ET.tostring(soil, with_tail=False)) for soil in soiltree
+            if isinstance(soil.tag, basestring)]
+
+def _save_cache(cachePath, soilList):
+    '''
+    Saves (name, xml) of each soil to a JSON file, which holds only strings
+    and so can't run code when it is loaded. Writes to a temporary file
+    first so other processes never read a partial cache.
+    '''
+    tmpPath = '{0}.{1}.tmp'.format(cachePath, os.getpid())
+    with open(tmpPath, 'wb') as f:
+        json.dump(soilList, f)
+    if not os.path.isfile(cachePath):
+        os.rename(tmpPath, cachePath)
+    else:
+        os.remove(tmpPath)
+
+def _load_cache(cachePath):
+    '''List of (name, xml) of each soil saved by _save_cache, or None if
+    there is no readable cache.'''
+    try:
+        with open(cachePath, 'rb') as f:
+            soilList = json.load(f)
+        # json gives unicode, the rest of the package uses str
+        return [(name if name == None else name.encode('utf-8'), xml.encode('utf-8'))
+                for name, xml in soilList]
+    except (IOError, ValueError, TypeError, AttributeError):
+        return None
+
+def load_library(filename, cacheDir=None):
+    '''
+    Reads a soils file once: later calls for the same file, while its size
+    and modification time are unchanged, use the library already loaded by
+    this process. Otherwise the file is hashed and a library cached on disk
+    by an earlier process for the same contents is used, if any.
+
+    Parameters
+    ----------
+    filename : string
+        soils file, ie hc27_v1_1.soils
+    cacheDir : string
+        (optional) directory of the on-disk cache (see
+        fileio.get_cache_dir)
+
+    Returns
+    -------
+    SoilLibrary of filename.
+    '''
+    stat = os.stat(filename)
+    key = hashlib.md5('{0}|{1}|{2!r}'.format(os.path.abspath(filename), stat.st_size, stat.st_mtime)).hexdigest()
+    if key in _libraries:
+        return _libraries[key]
+
+    md5 = fileio.get_file_hash(filename)
+    if cacheDir == None:
+        cacheDir = fileio.get_cache_dir()
+    soilList = None
+    if cacheDir != None:
+        cachePath = os.path.join(cacheDir, md5 + '.soils.json')
+        soilList = _load_cache(cachePath)
+    if soilList == None:
+        soilList = _parse_soils(filename)
+        if cacheDir != None:
+            try:
+                if not os.path.isdir(cacheDir):
+                    os.makedirs(cacheDir)
+                _save_cache(cachePath, soilList)
+            except (IOError, OSError):
+                # the cache is only an optimization
+                pass
+
+    library = SoilLibrary(filename, md5, soilList)
+    _libraries[key] = library
+    return library
 
 def add_soils(element, filename):
     ''' Adds all soils in filename to element.
-    
+
     Parameters
     ----------
     element : lxml element tree element
         element to add soils to
     filename : string
         filename to parse
-    
+
     Returns
     -------
     Nothing
     '''
-    
-    soiltree = ET.parse(filename).getroot()
-    for soil in soiltree:
-        element.append(soil)
-        #print(soil.tag, '-', soil.get('name'), '-', soil.text)
\ No newline at end of file
+    load_library(filename).add_soils(element)
@@ -5,13 +5,14 @@ Created on Tue Jun 19 22:54:23 2012
 @author: David
 """
 
-import subprocess, os, glob, sys
+import os, glob, sys
 from time import time
-from Queue import Queue
-import threading
 import multiprocessing as mp
 from datetime import timedelta, datetime
 import utils
+import scheduler
+import manifest
+import history
 
 # get APSIM install directory (where this module is running from)
 apsimPathname = os.path.dirname(sys.argv[0])
@@ -23,180 +24,153 @@ else: # linux
     apsimExePath = os.path.join(apsimPath, 'Apsim.x')
 
 # set static inputs
-counterSim = 0
 counterApsim = 0
-simFileTotal = 1
 apsimFileTotal = 1
-old_count = 0
-old_average = 0
 prevPrint = 0
-simRerunAttemps = 0
+simResults = []
 startTime = time()
 numCPU = None
+retryPolicy = scheduler.RetryPolicy()
+runManifest = None
+runtimeHistory = None
+sqliteFilename = 'apsimData.sqlite'
+archiveFilename = 'apsimData.tar.gz'
 
-def _update_avg(new_data, old_count, old_average):
-    '''Calculates moving average.'''
-    new_count = old_count + 1
-    new_average = ((old_average * old_count) + new_data) / new_count
-    old_count += 1
-    old_average = new_average
-    return new_average, old_count, old_average
+def _cb_sim(result, progress):
+    '''Callback function.'''
+    global prevPrint
+    if runManifest != None:
+        runManifest.record_result(result)
+    if runtimeHistory != None and result.success and result.retries == 0:
+        runtimeHistory.record(result.simFilename, result.wallTime)
+    if not result.success:
+        print 'Unable to process file : {0} ({1})'.format(result.simFilename, result.error)
+    percComplete = progress.percent()
+    eta = str(timedelta(seconds=round(progress.eta())))
+    if percComplete != prevPrint:
+        print '{percComplete}% ({counterSim}/{simFileTotal}) - {eta} remaining'.format(counterSim=progress.numDone,simFileTotal=progress.numJobs,percComplete=percComplete,eta=eta)
+        prevPrint = percComplete
+
+def _cb_dispatch(simFilename):
+    '''Callback function.'''
+    runManifest.record(simFilename, 'running')
 
-def _cb_apsim(result, lock, timeOld):
+def _cb_apsim(job):
     '''Callback function.'''
     global counterApsim
     global apsimFileTotal
-    with lock: # keeps counterApsim synchronized
-        counterApsim += 1
-        percent = int((counterApsim * 100.0)/apsimFileTotal)
-        print result, '({0}/{1}) - {2}%'.format(counterApsim,apsimFileTotal,percent)
-        
-def _run_apsim_to_sim(apsimFilename, lock):
-    '''Converts an .apsim file to .sim files.'''
-    global apsimToSimExePath
-    timeOld = time()
-    startupinfo = None
-    if 'win' in sys.platform:
-        si = subprocess.STARTUPINFO()
-        si.dwFlags = subprocess.STARTF_USESHOWWINDOW
-        #si.wShowWindow = 6 # SW_MINIMIZE
-        si.wShowWindow = 0 # SW_HIDE - hides cmd windows
-        startupinfo=si
-    apsimToSimTmpFilename = apsimFilename.replace('.apsim','.tmp')
-    with open(apsimToSimTmpFilename, 'w') as tmpFile:
-        subprocess.call([apsimToSimExePath, apsimFilename], startupinfo=startupinfo, stdout=tmpFile, stderr=tmpFile)
-    
-    _cb_apsim(apsimFilename, lock, timeOld)
+    counterApsim += 1
+    percent = int((counterApsim * 100.0)/apsimFileTotal)
+    print job.apsimFilename, '({0}/{1}) - {2}%'.format(counterApsim,apsimFileTotal,percent)
+    if job.missing != []:
+        print '*** Warning: ApsimToSim did not write {0} .sim files for {1} (exit code {2}).'.format(len(job.missing), job.apsimFilename, job.exitCode)
+        state = 'failed'
+    else:
+        state = 'converted'
+    runManifest.record(job.apsimFilename, state, simFilenames=job.simFilenames,
+                       missing=job.missing, exitCode=job.exitCode,
+                       md5=manifest.get_file_hash(job.apsimFilename))
+
+def _invalidate_saved_output(simFilenameList):
+    ''' Records in the run manifest that the output of simFilenameList saved
+    to the database and the archive by an earlier run is out of date, so
+    _post_run deletes it before adding the output of this run.'''
+    for filename, savedState in ((sqliteFilename, 'saved'), (archiveFilename, 'archived')):
+        record = runManifest.records.get(filename)
+        if record != None and record['state'] in (savedState, 'stale'):
+            staleSims = set(record.get('staleSims', [])) | set(simFilenameList)
+            runManifest.record(filename, 'stale', staleSims=sorted(staleSims))
     
-def _worker_apsim(queue, lock):
-    '''Process files from the queue.'''
-    for args in iter(queue.get, None):
-        try:
-            _run_apsim_to_sim(args, lock)
-        except Exception as e: # catch exceptions to avoid exiting the thread prematurely
-            print '{0} failed: {1}'.format(args, e)#, file=sys.stderr
+def _find_unfinished_work(apsimFilenameList, rerunFailed=False):
+    ''' Uses the run manifest to find what is left to do in the directory.
     
-def _apsim_exe_run(apsimFilenameList):
-    '''Converts .apsim files to .sim files.'''
-    global apsimFileTotal
-    apsimFileTotal = len(apsimFilenameList)
-    print 'Running ApsimToSim for {0} .apsim files...'.format(apsimFileTotal)
+    An .apsim file is converted again unless the manifest says it was
+    converted from a file with the same md5 and each of its .sim files is
+    either done, skipped or still on disk. Simulations that are not done
+    (never run, running when the last run was interrupted or failed) are
+    run again, as are the simulations of an .apsim file that has changed.
+    Simulations that failed in a way running them again would repeat (see
+    scheduler.RetryPolicy.should_rerun) are skipped unless rerunFailed.
     
-    # add .apsim files to Queue
-    q = Queue()
+    Returns
+    -------
+    List of .apsim files to convert, list of .sim files to run, set of .sim
+    files already done and set of failed .sim files skipped.
+    '''
+    doneSims = set(runManifest.with_state('done'))
+    skippedSims = set()
+    if not rerunFailed:
+        skippedSims.update(sim for sim in runManifest.with_state('failed') if sim.endswith('.sim') and
+                           not retryPolicy.should_rerun(runManifest.records[sim].get('reason')))
+    toConvert = []
+    expectedSims = set()
+    simFilenameList = []
     for apsimFilename in apsimFilenameList:
-        q.put_nowait(apsimFilename)
-        
-    # run .apsim files and start threads to convert
-    lock = threading.RLock()
-    threads = [threading.Thread(target=_worker_apsim, args=(q,lock)) for _ in range(numCPU)]
-    for t in threads:
-        t.daemon = False # program quits when threads die
-        t.start()
-    for _ in threads: q.put_nowait(None) # signal no more files
-    for t in threads: t.join() # wait for completion
-    
-def _cb_sim(result, lock, timeOld):
-    '''Callback function.'''
-    global counterSim
-    global numCPU
-    global old_count
-    global old_average
-    global simFileTotal
-    global prevPrint
-    with lock: # keeps counterSim synchronized
-        counterSim += 1
-        percComplete = int(round(float(counterSim) / simFileTotal * 100,1))
-        deltaT = time() - timeOld # get runtime
-        currentAvg, old_count, old_average = _update_avg(deltaT, old_count, old_average)
-        eta = ((simFileTotal - counterSim)*currentAvg/numCPU) + deltaT
-        eta = str(timedelta(seconds=round(eta)))
-        if percComplete != prevPrint:
-            print '{percComplete}% ({counterSim}/{simFileTotal}) - {eta} remaining'.format(counterSim=counterSim,simFileTotal=simFileTotal,percComplete=percComplete,eta=eta)
-            prevPrint = percComplete
-
-def _run_sim(simFilename, lock):
-    '''Runs a .sim file in APSIM.'''
-    global apsimExePath
-    global simRerunAttemps
-    timeOld = time()
-    sumFilename = simFilename.replace('.sim','.sum')
-    tmpFilename = simFilename.replace('.sim','.tmp')
-    startupinfo = None
-    if 'win' in sys.platform:
-        si = subprocess.STARTUPINFO()
-        si.dwFlags = subprocess.STARTF_USESHOWWINDOW
-        #si.wShowWindow = 6 # SW_MINIMIZE
-        si.wShowWindow = 0 # SW_HIDE - hides cmd windows
-        startupinfo = si
-    with open(tmpFilename, 'w') as tmpFile:
-        with open(sumFilename, 'w') as sumFile:
-            subprocess.call([apsimExePath, simFilename], stdout=sumFile, stderr=tmpFile, startupinfo=startupinfo)
-    with open(tmpFilename, 'r') as tmpFile:
-        lineList = tmpFile.readlines()
-        #print len(lineList)
-        if '100%' in lineList[-1]:
-            # delete .sim file after processing
-            os.remove(simFilename)
-            simRerunAttemps = 0
-        elif simRerunAttemps < 5:
-            # attempt to re-run sim file at most 5 times
-            _run_sim(simFilename, lock)
-            simRerunAttemps += 1
+        record = runManifest.records.get(apsimFilename)
+        if record != None and 'md5' in record and record['md5'] != manifest.get_file_hash(apsimFilename):
+            # the .apsim file changed since it was converted
+            _invalidate_saved_output(record['simFilenames'])
+            doneSims.difference_update(record['simFilenames'])
+            skippedSims.difference_update(record['simFilenames'])
+            record = None
+        if record != None and record['state'] == 'converted' and \
+                all(sim in doneSims or sim in skippedSims or os.path.isfile(sim) for sim in record['simFilenames']):
+            simFilenameList += [sim for sim in record['simFilenames'] if sim not in doneSims and sim not in skippedSims]
         else:
-            print 'Unable to process file :', simFilename
-            simRerunAttemps = 0
-    
-    _cb_sim(simFilename, lock, timeOld)
-    return sumFilename
+            toConvert.append(apsimFilename)
+            expectedSims.update(scheduler.get_sim_filenames(apsimFilename))
     
-def _worker_sim(queue, lock):
-    '''Process files from the queue.'''
-    for args in iter(queue.get, None):
-        try:
-            _run_sim(args, lock)
-        except Exception as e: # catch exceptions to avoid exiting the thread prematurely
-            print '{0} failed: {1}'.format(args, e)#, file=sys.stderr
+    # .sim files that don't come from an .apsim file in this directory
+    known = set(simFilenameList) | doneSims | skippedSims | expectedSims
+    simFilenameList += [sim for sim in sorted(glob.glob('*.sim')) if sim not in known]
     
-def _sim_run(simFilenameList):
-    '''Runs apsim in parallel for every .sim file in simFilenameList.'''
-    global simFileTotal
-    global counterSim
-    simFileTotal = len(simFilenameList)
-    print 'Running Apsim for {0} .sim files...'.format(simFileTotal)
-    
-    # Add .sim files to Queue
-    q = Queue()
-    for simFilename in simFilenameList:
-        q.put_nowait(simFilename)
-        
-    # Run .sim files and start threads
-    lock = threading.RLock()
-    threads = [threading.Thread(target=_worker_sim, args=(q,lock)) for _ in range(numCPU)]
-    for t in threads:
-        t.daemon = False # program quits when threads die
-        t.start()
-    for _ in threads: q.put_nowait(None) # signal no more files
-    for t in threads: t.join() # wait for completion
+    return toConvert, simFilenameList, doneSims, skippedSims
 
-def _apsim_run(apsimFilenameList):
+def _apsim_run(apsimFilenameList, simFilenameList, skipSims):
     '''Main section for running all of apsim.'''
+    global simResults
+    global apsimFileTotal
+    apsimFileTotal = len(apsimFilenameList)
+    print 'Running ApsimToSim for {0} .apsim files and Apsim for {1} .sim files...'.format(apsimFileTotal, len(simFilenameList))
     
-    # convert each .apsim file to .sim files
+    # convert each .apsim file to .sim files and run each .sim file as soon
+    # as it is written
     timeOld = time()
-    _apsim_exe_run(apsimFilenameList)
-    conversionRuntime = str(timedelta(seconds=round(time()-timeOld)))
-    
-    # find all sim files
-    simFilenameList = glob.glob('*.sim')
-    
-    # run all sim files
-    _sim_run(simFilenameList)
+    conversionJobs, results = scheduler.run_pipeline(apsimFilenameList, apsimToSimExePath,
+                                                     apsimExePath, numCPU,
+                                                     retryPolicy, _cb_sim,
+                                                     conversionCallback=_cb_apsim,
+                                                     simFilenameList=simFilenameList,
+                                                     skipSims=skipSims,
+                                                     dispatchCallback=_cb_dispatch,
+                                                     estimate=runtimeHistory.estimate)
+    simResults += results
+    if conversionJobs != []:
+        conversionRuntime = max(job.endTime for job in conversionJobs) - timeOld
+        conversionRuntime = str(timedelta(seconds=round(conversionRuntime)))
+    else:
+        conversionRuntime = None
     
     return conversionRuntime
     
 def _post_run(conversionRuntime):
-    ''' Steps to take after main apsim run is complete.'''
+    ''' Steps to take after main apsim run is complete.
+    
+    The run manifest records when the database and the archive are saved.
+    Once they have been, a resumed run adds its .out and .sum files to them
+    instead of replacing them, as the files of the earlier run have been
+    deleted. Output of simulations whose .apsim file has changed since
+    (see _invalidate_saved_output) is deleted from them first. Files are
+    only deleted after they are saved and archived, so an interrupted save
+    is done again when the run is resumed.
+    '''
+    # output saved by an earlier run and out of date
+    stalePointIds = []
+    if runManifest.state(sqliteFilename) == 'stale':
+        stalePointIds = [int(sim[:-len('.sim')].split('_')[-1]) for sim in runManifest.records[sqliteFilename]['staleSims']]
+    staleOutput = []
+    if runManifest.state(archiveFilename) == 'stale':
+        staleOutput = [sim.replace('.sim', ext) for sim in runManifest.records[archiveFilename]['staleSims'] for ext in ('.out', '.sum')]
     
     # save to database and archive
     print 'Compiling .out and .sum files...'
@@ -213,7 +187,9 @@ def _post_run(conversionRuntime):
         timeOld = time()
         sumFileList = glob.glob('*.sum')
         outputFilenameList = outFileList + sumFileList
-        utils.save_output_to_archive(outputFilenameList)
+        append = runManifest.state(archiveFilename) in ('archived', 'stale')
+        utils.save_output_to_archive(outputFilenameList, append=append, removeFilenames=staleOutput)
+        runManifest.record(archiveFilename, 'archived', numFiles=len(outputFilenameList))
         archiveRuntime = str(timedelta(seconds=round(time()-timeOld)))
         databaseRuntime = None
     else:
@@ -222,7 +198,10 @@ def _post_run(conversionRuntime):
         # save .out files to sqlite database
         print 'Saving SQLite database...'
         timeOld = time()
-        utils.save_output_to_sqlite(outFileList)
+        append = runManifest.state(sqliteFilename) in ('saved', 'stale')
+        utils.save_output_to_sqlite(outFileList, sqliteFilename, numCPU=numCPU, append=append,
+                                    removePointIds=stalePointIds)
+        runManifest.record(sqliteFilename, 'saved', numFiles=len(outFileList))
         databaseRuntime = str(timedelta(seconds=round(time()-timeOld)))
         
         # add .out and .sum files to archive
@@ -230,10 +209,14 @@ def _post_run(conversionRuntime):
         timeOld = time()
         sumFileList = glob.glob('*.sum')
         outputFilenameList = outFileList + sumFileList
-        utils.save_output_to_archive(outputFilenameList)
+        append = runManifest.state(archiveFilename) in ('archived', 'stale')
+        utils.save_output_to_archive(outputFilenameList, append=append, removeFilenames=staleOutput)
+        runManifest.record(archiveFilename, 'archived', numFiles=len(outputFilenameList))
         archiveRuntime = str(timedelta(seconds=round(time()-timeOld)))
+    runManifest.close()
         
-    # clean up (remove .tmp, .out, and .sum files)
+    # clean up (remove .tmp (including ApsimToSim .a2s.tmp logs), .out, and
+    # .sum files)
     print 'Cleaning up...'
     cleanupFilenameList = glob.glob('*.tmp')
     cleanupFilenameList += glob.glob('*.out')
@@ -248,7 +231,15 @@ def _post_run(conversionRuntime):
     print 'Start time :', str(datetime.fromtimestamp(round(startTime)))
     print 'End time :', str(datetime.fromtimestamp(round(time())))
     if conversionRuntime != None: print 'Conversion runtime :', conversionRuntime
-    print 'Average runtime per simulation :', str(timedelta(seconds=round(old_average)))
+    if simResults != []:
+        averageRuntime = sum(result.wallTime for result in simResults) / len(simResults)
+        numFailed = len([result for result in simResults if not result.success])
+        print 'Average runtime per simulation :', str(timedelta(seconds=round(averageRuntime)))
+        print 'Failed simulations :', numFailed
+        if numFailed > 0:
+            reasons = [result.reason for result in simResults if not result.success]
+            for reason in sorted(set(reasons)):
+                print '    {0} : {1}'.format(reason, reasons.count(reason))
     if databaseRuntime != None: print 'Save to database runtime:', databaseRuntime
     if archiveRuntime != None: print 'Archive runtime:', archiveRuntime
     print 'Total runtime :', str(timedelta(seconds=round(time()-startTime)))
@@ -257,10 +248,13 @@ def _post_run(conversionRuntime):
 def main(args):
     '''Runs all .apsim files in directory.
     
-    Example Usage: python .../ApsimRun.py [numCPU]
+    Example Usage: python .../ApsimRun.py [numCPU] [--rerun-failed]
     
     numCPU : integer
-        (optional) Sets to how many processors to use (default=all).'''
+        (optional) Sets to how many processors to use (default=all).
+    --rerun-failed
+        (optional) Also re-runs simulations that failed with a fatal APSIM
+        error in an earlier run of an unchanged .apsim file.'''
     
     print '---------------------- ApsimRun.py ----------------------'
     print 'A batch processing script for the APSIM crop model.'
@@ -268,8 +262,12 @@ def main(args):
     
     global numCPU
     global startTime
+    global runManifest
+    global runtimeHistory
     
     # set variables from command line args
+    rerunFailed = '--rerun-failed' in args
+    args = [arg for arg in args if arg != '--rerun-failed']
     if len(args) == 1:
         numCPU = mp.cpu_count()
         print 'CPU count set to use all available processors.'
@@ -281,28 +279,40 @@ def main(args):
             print '** Warning: Too many threads. CPU count set to use all available processors.'
     else:
         print 'Error. Please provide valid input.'
-        print 'Ex: python ApsimRun.py [numCPU]'
+        print 'Ex: python ApsimRun.py [numCPU] [--rerun-failed]'
     
     print 'Number of CPU cores to use:', numCPU
     
-    # find all apsim files
-    apsimFilenameList = glob.glob('*.apsim')
+    # find what is left to do, using the run manifest (apsimRun.manifest)
+    # from any previous run in this directory
+    runManifest = manifest.RunManifest()
+    apsimFilenameList, simFilenameList, doneSims, skippedSims = _find_unfinished_work(glob.glob('*.apsim'), rerunFailed)
+    if doneSims != set():
+        print '** {0} simulations already done.'.format(len(doneSims))
+    if skippedSims != set():
+        print '** Skipping {0} simulations that failed with a fatal error in an earlier run (use --rerun-failed to run them again).'.format(len(skippedSims))
+    failedList = [sim for sim in runManifest.with_state('failed') + runManifest.with_state('running')
+                  if sim.endswith('.sim') and sim not in skippedSims]
+    if failedList != []:
+        reasons = [runManifest.records[sim].get('reason', 'interrupted') for sim in failedList]
+        print 'Re-running {0} unfinished simulations ({1})'.format(len(failedList), ', '.join('{0}: {1}'.format(reason, reasons.count(reason)) for reason in sorted(set(reasons))))
     
-    # check to see if there are any sim files already in directory
-    # if so, run them. Otherwise, find more.
-    simFilenameList = glob.glob('*.sim')
-    conversionRuntime = None
-    if simFilenameList != []:
-        print '** {0} .sim files found!'.format(len(simFilenameList))
-        print 'Running .sim files...'
-        
-        # run all sim files in list
-        _sim_run(simFilenameList)
+    # runtimes of earlier runs, to run the longest simulations first. Runs
+    # made by preprocess.py have config.ini one directory up and share
+    # runtimes across the experiment.
+    configPath = os.path.join(os.pardir, 'config.ini')
+    if os.path.isfile(configPath):
+        historyPath = os.path.join(os.pardir, os.pardir, 'apsimRuntimes.sqlite')
     else:
-        print '** No .sim files found!'
-        
-        # run apsim
-        conversionRuntime = _apsim_run(apsimFilenameList)
+        historyPath = 'apsimRuntimes.sqlite'
+    runtimeHistory = history.RuntimeHistory(historyPath, history.get_config_key(configPath))
+    
+    # run apsim
+    try:
+        conversionRuntime = _apsim_run(apsimFilenameList, simFilenameList, doneSims | skippedSims)
+    finally:
+        runManifest.close()
+        runtimeHistory.close()
 
     _post_run(conversionRuntime)
     
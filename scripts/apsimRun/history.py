@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Saved simulation runtimes, used to run the longest simulations first and to
+estimate the time remaining.
+
+Runtimes are keyed by grid point and by the run's configuration, so a run
+with the same config.ini uses exact runtimes and a run with a new
+configuration falls back to the runtimes of the same grid points.
+
+The database is shared by the runs of an experiment, which may run at the
+same time, so each runtime is committed as it is saved and a run waits up
+to timeout seconds for another one holding the database.
+"""
+
+import os, hashlib
+import sqlite3 as lite
+
+def get_point_id(simFilename):
+    '''Grid point of a simulation, ie 979 for NARR32_maize_00979.sim (None
+    if the name doesn't end in a point number).'''
+    name = os.path.splitext(os.path.basename(simFilename))[0]
+    try:
+        return int(name.split('_')[-1])
+    except ValueError:
+        return None
+
+def get_config_key(configPath):
+    '''md5 of a config file, or '' if it does not exist.'''
+    if not os.path.isfile(configPath):
+        return ''
+    with open(configPath, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+class RuntimeHistory:
+    ''' Reads and saves simulation runtimes in an SQLite database.
+
+    Attributes
+    ----------
+    path : string
+        database filename
+    configKey : string
+        configuration of the current run (see get_config_key)
+    '''
+    def __init__(self, path, configKey='', timeout=60.0):
+        self.path = path
+        self.configKey = configKey
+        self._conn = lite.connect(path, timeout=timeout)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS runtimes (point_id integer, config text, wall_time real, "
+                               "PRIMARY KEY (point_id, config))")
+
+        # load runtimes for this configuration and averages over all others
+        self._runtimes = {}
+        self._pointRuntimes = {}
+        for pointId, config, wallTime in self._conn.execute("SELECT point_id, config, wall_time FROM runtimes"):
+            if config == configKey:
+                self._runtimes[pointId] = wallTime
+            self._pointRuntimes.setdefault(pointId, []).append(wallTime)
+        for pointId, wallTimes in self._pointRuntimes.iteritems():
+            self._pointRuntimes[pointId] = sum(wallTimes) / len(wallTimes)
+
+    def estimate(self, simFilename):
+        ''' Expected runtime (s) of a simulation.
+
+        Returns
+        -------
+        The saved runtime for this grid point and configuration, else the
+        average for this grid point over other configurations, else None.
+        '''
+        pointId = get_point_id(simFilename)
+        if pointId in self._runtimes:
+            return self._runtimes[pointId]
+        return self._pointRuntimes.get(pointId)
+
+    def record(self, simFilename, wallTime):
+        '''Saves the runtime (s) of a simulation of this configuration.'''
+        pointId = get_point_id(simFilename)
+        if pointId == None:
+            return
+        self._runtimes[pointId] = wallTime
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO runtimes VALUES (?,?,?)", (pointId, self.configKey, wallTime))
+
+    def close(self):
+        '''Closes the database.'''
+        self._conn.close()
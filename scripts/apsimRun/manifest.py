@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Per-directory record of what happened to each simulation of an ApsimRun run.
+
+The manifest is a JSON-lines file. Every change of state appends one line, so
+a run that is interrupted leaves the manifest readable up to the last
+complete line. The last line for a simulation is its current state.
+"""
+
+import os, json, hashlib
+from time import time
+
+def get_file_hash(path):
+    '''md5 of a file, read in blocks.'''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+class RunManifest:
+    ''' Reads and appends to a run manifest.
+
+    Attributes
+    ----------
+    path : string
+        manifest filename
+    records : dict
+        'simFilename':{'sim':..., 'state':..., 'time':..., ...} mapping
+        holding the latest record of each simulation
+    '''
+    def __init__(self, path='apsimRun.manifest'):
+        self.path = path
+        self.records = {}
+        self._file = None
+        if os.path.isfile(path):
+            self._load()
+
+    def _load(self):
+        '''Reads the latest record of each simulation.'''
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # line cut short by a crash
+                    continue
+                self.records[record['sim']] = record
+
+    def record(self, simFilename, state, **fields):
+        ''' Saves the state of a simulation, along with any other fields.
+
+        Parameters
+        ----------
+        simFilename : string
+            .sim file of the simulation
+        state : string
+            state of the simulation ie 'done' or 'failed'
+        fields : keyword arguments
+            other values to save, must be JSON serializable
+
+        Returns
+        -------
+        The record saved.
+        '''
+        record = dict(fields)
+        record['sim'] = simFilename
+        record['state'] = state
+        record['time'] = time()
+        if self._file == None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records[simFilename] = record
+        return record
+
+    def record_result(self, result):
+        '''Saves a scheduler.SimResult as 'done' or 'failed'.'''
+        if result.success:
+            state = 'done'
+        else:
+            state = 'failed'
+        return self.record(result.simFilename, state,
+                           reason=result.reason,
+                           failures=result.failures,
+                           error=result.error,
+                           exitCode=result.exitCode,
+                           retries=result.retries,
+                           wallTime=result.wallTime,
+                           outFilenames=result.outFilenames)
+
+    def state(self, simFilename):
+        '''Latest state of a simulation (None if it was never recorded).'''
+        record = self.records.get(simFilename)
+        if record == None:
+            return None
+        return record['state']
+
+    def with_state(self, state):
+        '''Sorted list of simulations whose latest state is state.'''
+        return sorted(sim for sim, record in self.records.iteritems() if record['state'] == state)
+
+    def close(self):
+        '''Closes the manifest file.'''
+        if self._file != None:
+            self._file.close()
+            self._file = None
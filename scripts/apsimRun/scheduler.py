@@ -0,0 +1,703 @@
+# -*- coding: utf-8 -*-
+"""
+Runs APSIM .sim files in a bounded pool of worker processes.
+
+Each simulation keeps its own retry state and returns a SimResult instead of
+printing, so callers decide how to report progress. The APSIM executable is
+a parameter and may be given as a command list, ie [sys.executable,
+'fakeApsim.py'], to run the scheduler against a fake executable.
+
+run_pipeline also converts .apsim files with ApsimToSim and queues each .sim
+file as soon as it has been written, so conversion and simulation overlap.
+"""
+
+import subprocess, os, sys, heapq, signal
+from time import time, sleep
+from Queue import Queue, Empty
+import multiprocessing as mp
+import xml.etree.cElementTree as ET
+
+class SimResult:
+    ''' Result of running one .sim file.
+
+    Attributes
+    ----------
+    simFilename : string
+        .sim file that was run
+    exitCode : int
+        exit code of the last attempt (None if APSIM could not be started)
+    wallTime : float
+        runtime (s) of all attempts
+    retries : int
+        number of times the simulation was re-run after failing
+    success : bool
+        True if APSIM reported the simulation 100% complete
+    sumFilename : string
+        summary file (APSIM stdout)
+    tmpFilename : string
+        log file (APSIM stderr)
+    outFilenames : list
+        .out files the simulation writes
+    error : string
+        why the simulation failed (None if it succeeded)
+    reason : string
+        failure class of the last attempt from classify_failure, or 'done'
+    failures : list
+        failure class of every failed attempt
+    '''
+    def __init__(self, simFilename, exitCode, wallTime, retries, success,
+                 sumFilename, tmpFilename, outFilenames, error=None,
+                 reason=None, failures=None):
+        self.simFilename = simFilename
+        self.exitCode = exitCode
+        self.wallTime = wallTime
+        self.retries = retries
+        self.success = success
+        self.sumFilename = sumFilename
+        self.tmpFilename = tmpFilename
+        self.outFilenames = outFilenames
+        self.error = error
+        if reason == None:
+            reason = 'done' if success else 'unknown'
+        self.reason = reason
+        if failures == None:
+            failures = []
+        self.failures = failures
+
+class RetryPolicy:
+    ''' Decides if and when a failed simulation is run again.
+
+    Attributes
+    ----------
+    maxAttempts : int
+        times a simulation is run before it is reported failed
+    backoff : float
+        seconds to wait before the first retry, doubled for each retry after
+    maxBackoff : float
+        longest wait (s) between retries
+    retryReasons : tuple
+        failure classes (see classify_failure) worth retrying. A 'fatal'
+        APSIM error fails the same way every time, so it is not retried.
+    '''
+    def __init__(self, maxAttempts=6, backoff=1., maxBackoff=60.,
+                 retryReasons=('crash', 'incomplete')):
+        self.maxAttempts = maxAttempts
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.retryReasons = retryReasons
+
+    def should_retry(self, reason, attempt):
+        '''True if a simulation that failed attempt (1, 2...) with reason
+        should be run again.'''
+        return reason in self.retryReasons and attempt < self.maxAttempts
+
+    def should_rerun(self, reason):
+        ''' True if a simulation that failed with reason in an earlier run
+        is worth running again in a new run: failures that are retried, and
+        failures to start APSIM or of this script ('launch', 'error',
+        'unknown'), which a new run may not repeat. Other failures (a
+        'fatal' APSIM error) fail the same way until the simulation
+        changes.'''
+        return reason in self.retryReasons or reason in ('launch', 'error', 'unknown', None)
+
+    def delay(self, retry):
+        '''Seconds to wait before retry (1, 2...).'''
+        return min(self.backoff * 2 ** (retry - 1), self.maxBackoff)
+
+class Progress:
+    ''' Tracks finished simulations and estimates the time remaining.
+
+    The estimate uses the expected runtime of each unfinished simulation
+    (from estimate, ie saved runtimes of earlier runs) scaled by how long
+    finished simulations took compared to their estimates. Simulations
+    without an estimate count as the average runtime so far.
+    '''
+    def __init__(self, numJobs, numCPU, estimate=None):
+        self.numJobs = numJobs
+        self.numCPU = numCPU
+        self.numDone = 0
+        self.numFailed = 0
+        self.totalTime = 0.
+        self._estimate = estimate
+        self._estimates = {}
+        self._estimatedWork = 0.  # sum of estimates of unfinished jobs
+        self._numUnestimated = numJobs
+        self._estimatedTime = 0.  # sum of estimates of finished jobs
+        self._actualTime = 0.     # runtimes of finished jobs with estimates
+
+    def add_jobs(self, simFilenames):
+        '''Adds simulations to be run.'''
+        for simFilename in simFilenames:
+            self.numJobs += 1
+            estimate = None
+            if self._estimate != None:
+                estimate = self._estimate(simFilename)
+            if estimate == None:
+                self._numUnestimated += 1
+            else:
+                self._estimates[simFilename] = estimate
+                self._estimatedWork += estimate
+
+    def remove_jobs(self, simFilenames):
+        '''Removes simulations that will not be run.'''
+        for simFilename in simFilenames:
+            self.numJobs -= 1
+            self._remove_estimate(simFilename)
+
+    def _remove_estimate(self, simFilename):
+        estimate = self._estimates.pop(simFilename, None)
+        if estimate == None:
+            self._numUnestimated -= 1
+        else:
+            self._estimatedWork -= estimate
+        return estimate
+
+    def update(self, result):
+        '''Adds a finished SimResult.'''
+        self.numDone += 1
+        self.totalTime += result.wallTime
+        if not result.success:
+            self.numFailed += 1
+        estimate = self._remove_estimate(result.simFilename)
+        if estimate != None:
+            self._estimatedTime += estimate
+            self._actualTime += result.wallTime
+
+    def average(self):
+        '''Average runtime (s) per simulation so far.'''
+        if self.numDone == 0:
+            return 0.
+        return self.totalTime / self.numDone
+
+    def percent(self):
+        '''Percent of simulations finished.'''
+        return int(round(float(self.numDone) / max(self.numJobs, 1) * 100))
+
+    def eta(self):
+        '''Estimated time remaining (s).'''
+        scale = 1.
+        if self._estimatedTime > 0:
+            scale = self._actualTime / self._estimatedTime
+        work = self._estimatedWork * scale + max(self._numUnestimated, 0) * self.average()
+        return work / self.numCPU
+
+class ConversionJob:
+    ''' Conversion of one .apsim file to .sim files by ApsimToSim.
+
+    Attributes
+    ----------
+    apsimFilename : string
+        .apsim file to convert
+    simFilenames : list
+        .sim files the conversion should write, one per enabled simulation
+    queued : list
+        .sim files queued to run so far
+    missing : list
+        .sim files that were not written (known once the conversion ends)
+    skipped : list
+        .sim files not run because they were already done (deleted once
+        the conversion ends)
+    tmpFilename : string
+        ApsimToSim log (stdout and stderr). Named .a2s.tmp, as the .tmp log
+        of a simulation named after the .apsim file (ie with
+        splitSimulations) is written while the conversion is still running.
+    exitCode : int
+        exit code of ApsimToSim (None while running)
+    startTime : float
+        time the conversion started
+    endTime : float
+        time the conversion ended (None while running)
+    '''
+    def __init__(self, apsimFilename, skip=()):
+        self.apsimFilename = apsimFilename
+        self.simFilenames = get_sim_filenames(apsimFilename)
+        self.queued = []
+        self.missing = []
+        self.skipped = [simFilename for simFilename in self.simFilenames if simFilename in skip]
+        self.tmpFilename = os.path.splitext(apsimFilename)[0] + '.a2s.tmp'
+        self.exitCode = None
+        self.startTime = None
+        self.endTime = None
+        self._process = None
+        self._queued = set(self.skipped)
+
+    def start(self, apsimToSimExePath):
+        '''Starts ApsimToSim without waiting for it.'''
+        # .sim files left by an earlier, interrupted conversion are stale
+        for simFilename in self.simFilenames:
+            if os.path.isfile(simFilename):
+                os.remove(simFilename)
+        with open(self.tmpFilename, 'w') as tmpFile:
+            self._process = subprocess.Popen(get_command(apsimToSimExePath, self.apsimFilename),
+                                             stdout=tmpFile, stderr=tmpFile,
+                                             startupinfo=get_startupinfo())
+        self.startTime = time()
+
+    def poll(self):
+        ''' Finds .sim files that are ready to run.
+
+        Returns
+        -------
+        List of .sim files written since the last poll.
+        '''
+        done = self._process.poll() != None
+        ready = []
+        for simFilename in self.simFilenames:
+            if simFilename in self._queued:
+                continue
+            if done and os.path.isfile(simFilename) or _is_sim_written(simFilename):
+                ready.append(simFilename)
+                self._queued.add(simFilename)
+        self.queued += ready
+        if done:
+            self.exitCode = self._process.returncode
+            self.endTime = time()
+            self.missing = [simFilename for simFilename in self.simFilenames if simFilename not in self._queued]
+            for simFilename in self.skipped:
+                if os.path.isfile(simFilename):
+                    os.remove(simFilename)
+        return ready
+
+    def done(self):
+        '''True once ApsimToSim has exited and every .sim file was polled.'''
+        return self.endTime != None
+
+    def kill(self):
+        '''Kills ApsimToSim if it is still running and waits for it.'''
+        if self._process != None and self._process.poll() == None:
+            self._process.kill()
+            self._process.wait()
+
+def get_sim_filenames(apsimFilename):
+    ''' Finds the .sim files ApsimToSim writes for an .apsim file, one for
+    each enabled simulation, named after the simulation.
+
+    Returns
+    -------
+    List of .sim filenames.
+    '''
+    simFilenames = []
+    for event, element in ET.iterparse(apsimFilename, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'simulation' and element.get('enabled') != 'no':
+                simFilenames.append(element.get('name') + '.sim')
+        elif element.tag == 'simulation':
+            element.clear()
+    return simFilenames
+
+def _is_sim_written(simFilename):
+    '''Checks if a .sim file exists and ends with its closing tag.'''
+    try:
+        with open(simFilename, 'rb') as simFile:
+            simFile.seek(0, os.SEEK_END)
+            simFile.seek(max(simFile.tell() - 64, 0))
+            return simFile.read().rstrip().endswith('</simulation>')
+    except IOError:
+        return False
+
+def get_startupinfo():
+    '''Hides the cmd window of subprocesses on Windows.'''
+    startupinfo = None
+    if 'win' in sys.platform:
+        si = subprocess.STARTUPINFO()
+        si.dwFlags = subprocess.STARTF_USESHOWWINDOW
+        si.wShowWindow = 0 # SW_HIDE - hides cmd windows
+        startupinfo = si
+    return startupinfo
+
+def get_command(exePath, filename):
+    ''' Creates the command to run exePath on filename.
+
+    Parameters
+    ----------
+    exePath : string or list
+        path to the executable, or a command list ie [python, script]
+    filename : string
+        file to pass to the executable
+
+    Returns
+    -------
+    The command as a list.
+    '''
+    if isinstance(exePath, (list, tuple)):
+        return list(exePath) + [filename]
+    return [exePath, filename]
+
+def order_longest_first(simFilenames, estimate=None):
+    ''' Orders simulations longest first (longest-processing-time-first
+    scheduling), so long simulations don't end up last on an otherwise
+    idle machine.
+
+    Parameters
+    ----------
+    simFilenames : list
+        .sim files to order
+    estimate : function
+        (optional) estimate(simFilename) returns the expected runtime (s),
+        or None if unknown
+
+    Returns
+    -------
+    List of .sim files. Simulations with no estimate come first, in their
+    original order, as they could be the longest.
+    '''
+    if estimate == None:
+        return list(simFilenames)
+    keys = [(_get_priority(simFilename, estimate), position, simFilename)
+            for position, simFilename in enumerate(simFilenames)]
+    return [key[-1] for key in sorted(keys)]
+
+def _get_priority(simFilename, estimate):
+    '''Sort key that puts unknown, then longest, simulations first.'''
+    runtime = None
+    if estimate != None:
+        runtime = estimate(simFilename)
+    if runtime == None:
+        return (0, 0.)
+    return (1, -runtime)
+
+def _get_out_filenames(simFilename):
+    ''' Finds the .out files a .sim file writes.
+
+    Returns
+    -------
+    List of .out filenames, empty if the .sim file can't be read.
+    '''
+    outFilenames = []
+    try:
+        for event, element in ET.iterparse(simFilename):
+            text = element.text
+            if text != None and text.strip().endswith('.out'):
+                outFilenames.append(text.strip())
+            element.clear()
+    except (IOError, SyntaxError):
+        pass
+    return outFilenames
+
+def _read_tail(filename, numBytes=4096):
+    '''Reads the last numBytes of a file ('' if it can't be read).'''
+    try:
+        with open(filename, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - numBytes, 0))
+            return f.read()
+    except IOError:
+        return ''
+
+def classify_failure(tmpFilename, exitCode):
+    ''' Classifies an APSIM run from the tail of its log (stderr).
+
+    Parameters
+    ----------
+    tmpFilename : string
+        APSIM log file
+    exitCode : int
+        exit code of APSIM
+
+    Returns
+    -------
+    'done' if APSIM reported 100% on its last line, else the failure class:
+        'fatal' : APSIM reported a fatal error (ie bad inputs)
+        'crash' : APSIM exited with an error code, was killed or wrote NULL
+                  bytes, without reporting a fatal error
+        'incomplete' : APSIM exited normally without reaching 100%
+    '''
+    tail = _read_tail(tmpFilename)
+    lineList = tail.strip().splitlines()
+    if lineList != [] and '100%' in lineList[-1]:
+        return 'done'
+    elif 'fatal error' in ' '.join(tail.lower().split()):
+        return 'fatal'
+    elif exitCode != 0 or '\0' in tail:
+        return 'crash'
+    else:
+        return 'incomplete'
+
+def _call(command, **kwargs):
+    ''' Runs command and waits for it, like subprocess.call, but kills it if
+    the wait is interrupted (ie the worker is terminated, see _init_worker).
+
+    Returns
+    -------
+    The exit code of command.
+    '''
+    process = subprocess.Popen(command, **kwargs)
+    try:
+        return process.wait()
+    except BaseException:
+        if process.poll() == None:
+            process.kill()
+            process.wait()
+        raise
+
+def _init_worker():
+    '''Worker process initializer: Pool.terminate sends SIGTERM, which is
+    raised as SystemExit so _call kills the running APSIM process.'''
+    signal.signal(signal.SIGTERM, _exit_worker)
+
+def _exit_worker(signum, frame):
+    raise SystemExit(1)
+
+def _run_sim_job(args):
+    '''Runs run_sim, reporting any exception as a failed SimResult.'''
+    try:
+        return run_sim(args)
+    except Exception as e:
+        simFilename = args[0]
+        return SimResult(simFilename, None, 0., 0, False,
+                         simFilename.replace('.sim','.sum'),
+                         simFilename.replace('.sim','.tmp'), [], repr(e),
+                         'error', ['error'])
+
+def run_sim(args):
+    ''' Runs a .sim file in APSIM, re-running it as retryPolicy allows until
+    it succeeds. Deletes the .sim file if it succeeds. Used by the worker
+    processes of run_sims and run_pipeline.
+
+    Parameters
+    ----------
+    args : tuple
+        (simFilename, apsimExePath, retryPolicy)
+
+    Returns
+    -------
+    A SimResult.
+    '''
+    simFilename, apsimExePath, retryPolicy = args
+    sumFilename = simFilename.replace('.sim','.sum')
+    tmpFilename = simFilename.replace('.sim','.tmp')
+    outFilenames = _get_out_filenames(simFilename)
+    command = get_command(apsimExePath, simFilename)
+
+    timeOld = time()
+    attempt = 0
+    error = None
+    failures = []
+    while True:
+        attempt += 1
+        try:
+            with open(tmpFilename, 'w') as tmpFile:
+                with open(sumFilename, 'w') as sumFile:
+                    exitCode = _call(command, stdout=sumFile, stderr=tmpFile, startupinfo=get_startupinfo())
+        except OSError as e:
+            exitCode = None
+            error = str(e)
+            reason = 'launch'
+            failures.append(reason)
+            break
+        reason = classify_failure(tmpFilename, exitCode)
+        if reason == 'done':
+            break
+        failures.append(reason)
+        if not retryPolicy.should_retry(reason, attempt):
+            break
+        sleep(retryPolicy.delay(attempt))
+    wallTime = time() - timeOld
+
+    success = reason == 'done'
+    if success:
+        # delete .sim file after processing
+        os.remove(simFilename)
+    elif error == None:
+        error = '{0} after {1} attempts (exit code {2})'.format(reason, attempt, exitCode)
+
+    return SimResult(simFilename, exitCode, wallTime, attempt - 1, success,
+                     sumFilename, tmpFilename, outFilenames, error, reason, failures)
+
+def run_sims(simFilenameList, apsimExePath, numCPU=None, retryPolicy=None, callback=None,
+             dispatchCallback=None, estimate=None):
+    ''' Runs .sim files in a pool of numCPU worker processes.
+
+    Parameters
+    ----------
+    simFilenameList : list
+        .sim files to run
+    apsimExePath : string or list
+        path to Apsim.exe/Apsim.x, or a command list
+    numCPU : int
+        (optional) number of worker processes (default=all)
+    retryPolicy : RetryPolicy
+        (optional) when to re-run failed simulations (default=RetryPolicy())
+    callback : function
+        (optional) called as callback(result, progress) in this process
+        after each simulation finishes
+    dispatchCallback : function
+        (optional) called as dispatchCallback(simFilename) in this process
+        when a simulation is handed to the pool
+    estimate : function
+        (optional) estimate(simFilename) returns the expected runtime (s) or
+        None. Used to run the longest simulations first and for the ETA.
+
+    Returns
+    -------
+    List of SimResult, in the order the simulations finished.
+    '''
+    if numCPU == None:
+        numCPU = mp.cpu_count()
+    if retryPolicy == None:
+        retryPolicy = RetryPolicy()
+    simFilenameList = order_longest_first(simFilenameList, estimate)
+    jobs = [(simFilename, apsimExePath, retryPolicy) for simFilename in simFilenameList]
+    progress = Progress(0, numCPU, estimate)
+    progress.add_jobs(simFilenameList)
+    results = []
+    if jobs == []:
+        return results
+
+    if dispatchCallback != None:
+        for simFilename in simFilenameList:
+            dispatchCallback(simFilename)
+    pool = mp.Pool(min(numCPU, len(jobs)), _init_worker)
+    try:
+        finished = pool.imap_unordered(_run_sim_job, jobs, chunksize=1)
+        while True:
+            # wait with a timeout, or python 2 ignores Ctrl-C until the next
+            # simulation finishes
+            try:
+                result = finished.next(timeout=1)
+            except mp.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            results.append(result)
+            progress.update(result)
+            if callback != None:
+                callback(result, progress)
+        pool.close()
+    except BaseException:
+        # stop the queued and running simulations instead of waiting for them
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return results
+
+def run_pipeline(apsimFilenameList, apsimToSimExePath, apsimExePath, numCPU=None,
+                 retryPolicy=None, callback=None, conversionCallback=None, pollInterval=0.5,
+                 simFilenameList=None, skipSims=None, dispatchCallback=None, estimate=None):
+    ''' Converts .apsim files to .sim files and runs each .sim file as soon
+    as it has been written, without waiting for the conversions to finish.
+
+    Parameters
+    ----------
+    apsimFilenameList : list
+        .apsim files to convert and run
+    apsimToSimExePath : string or list
+        path to ApsimToSim.exe, or a command list
+    apsimExePath : string or list
+        path to Apsim.exe/Apsim.x, or a command list
+    numCPU : int
+        (optional) number of processes (default=all), shared by simulations
+        and ApsimToSim conversions so that no more than numCPU run at once.
+        Ready simulations go first; conversions start on processes that no
+        ready simulation can use.
+    retryPolicy : RetryPolicy
+        (optional) when to re-run failed simulations (default=RetryPolicy())
+    callback : function
+        (optional) called as callback(result, progress) after each
+        simulation finishes
+    conversionCallback : function
+        (optional) called as conversionCallback(job) after each conversion
+        finishes
+    pollInterval : float
+        (optional) seconds between checks for new .sim files
+    simFilenameList : list
+        (optional) .sim files already on disk to run along with the
+        converted ones
+    skipSims : set
+        (optional) .sim files not to run (ie already done in a previous run)
+    dispatchCallback : function
+        (optional) called as dispatchCallback(simFilename) when a
+        simulation is handed to the pool
+    estimate : function
+        (optional) estimate(simFilename) returns the expected runtime (s) or
+        None. Simulations wait here until a worker is free and the longest
+        known one goes first. Also used for the ETA.
+
+    Returns
+    -------
+    List of ConversionJob and list of SimResult, in the order they finished.
+    '''
+    if numCPU == None:
+        numCPU = mp.cpu_count()
+    if retryPolicy == None:
+        retryPolicy = RetryPolicy()
+    if simFilenameList == None:
+        simFilenameList = []
+    if skipSims == None:
+        skipSims = set()
+    waiting = list(apsimFilenameList)
+    converting = []
+    conversionJobs = []
+    results = []
+    progress = Progress(0, numCPU, estimate)
+    finished = Queue()
+    numPending = 0
+
+    pool = mp.Pool(numCPU, _init_worker)
+    try:
+        # .sim files already on disk, then .sim files as they are written
+        ready = [] # heap of (priority, order, simFilename)
+        newSims = list(simFilenameList)
+        progress.add_jobs(newSims)
+        numQueued = 0
+        while newSims != [] or ready != [] or waiting != [] or converting != [] or numPending > 0:
+            # queue .sim files as they are written
+            for job in converting[:]:
+                newSims += job.poll()
+                if job.done():
+                    converting.remove(job)
+                    conversionJobs.append(job)
+                    progress.remove_jobs(job.missing)
+                    if conversionCallback != None:
+                        conversionCallback(job)
+
+            # hand the longest simulations to free workers
+            for simFilename in newSims:
+                heapq.heappush(ready, (_get_priority(simFilename, estimate), numQueued, simFilename))
+                numQueued += 1
+            newSims = []
+            while ready != [] and numPending + len(converting) < numCPU:
+                simFilename = heapq.heappop(ready)[-1]
+                if dispatchCallback != None:
+                    dispatchCallback(simFilename)
+                pool.apply_async(_run_sim_job, ((simFilename, apsimExePath, retryPolicy),), callback=finished.put)
+                numPending += 1
+
+            # start conversions on the processes no ready simulation can use
+            while waiting != [] and ready == [] and numPending + len(converting) < numCPU:
+                job = ConversionJob(waiting.pop(0), skipSims)
+                job.start(apsimToSimExePath)
+                progress.add_jobs([sim for sim in job.simFilenames if sim not in job.skipped])
+                converting.append(job)
+
+            # collect finished simulations
+            try:
+                result = finished.get(timeout=pollInterval) if numPending > 0 else None
+            except Empty:
+                result = None
+            if result == None and numPending == 0 and converting != []:
+                sleep(pollInterval)
+            while result != None:
+                numPending -= 1
+                results.append(result)
+                progress.update(result)
+                if callback != None:
+                    callback(result, progress)
+                try:
+                    result = finished.get_nowait()
+                except Empty:
+                    result = None
+        pool.close()
+    except BaseException:
+        # stop running simulations and conversions instead of waiting for
+        # them, so no ApsimToSim keeps writing .sim files after this returns
+        pool.terminate()
+        for job in converting:
+            job.kill()
+        raise
+    finally:
+        pool.join()
+
+    return conversionJobs, results
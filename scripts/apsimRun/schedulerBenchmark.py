@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the makespan (time until the last simulation finishes) of
+longest-processing-time-first ordering against FIFO (glob) ordering.
+
+benchmark_simulated replays the ordering on a simulated many-core machine.
+benchmark_fake_apsim runs scheduler.run_sims with a fake APSIM executable that
+sleeps for each simulation's runtime.
+
+Ex: python schedulerBenchmark.py
+"""
+import os, sys, shutil, tempfile, heapq
+from time import time
+import numpy as np
+import scheduler
+
+def _get_makespan(runtimes, order, numCPU):
+    ''' Replays list scheduling: each simulation in order goes to the first
+    free core.
+
+    Returns
+    -------
+    Makespan (s).
+    '''
+    cores = [0.] * numCPU
+    for simFilename in order:
+        heapq.heappush(cores, heapq.heappop(cores) + runtimes[simFilename])
+    return max(cores)
+
+def _get_runtimes(numSims, seed=0):
+    ''' Random simulation runtimes (s), lognormal like runtimes that vary
+    with the weather and soil of each grid point.
+
+    Returns
+    -------
+    List of .sim filenames in glob order and dictionary of their runtimes.
+    '''
+    random = np.random.RandomState(seed)
+    simFilenames = ['NARR32_maize_{0:05d}.sim'.format(n) for n in range(numSims)]
+    runtimes = dict(zip(simFilenames, random.lognormal(np.log(60.), 0.8, numSims)))
+    return simFilenames, runtimes
+
+def _get_estimates(runtimes, noise, seed=1):
+    '''Runtimes from an earlier run: the runtimes with relative noise.'''
+    random = np.random.RandomState(seed)
+    return dict((simFilename, runtime * max(1 + random.normal(0, noise), 0.1))
+                for simFilename, runtime in runtimes.iteritems())
+
+def benchmark_simulated(numSims=5000, numCPU=64, noise=0.2):
+    ''' Compares the makespan of FIFO and longest-first ordering of numSims
+    simulations on numCPU cores, with estimates off by noise (relative
+    standard deviation).
+
+    Returns
+    -------
+    Makespans (s) of FIFO and longest-first ordering.
+    '''
+    simFilenames, runtimes = _get_runtimes(numSims)
+    estimates = _get_estimates(runtimes, noise)
+    lowerBound = max(sum(runtimes.values()) / numCPU, max(runtimes.values()))
+
+    fifoMakespan = _get_makespan(runtimes, simFilenames, numCPU)
+    order = scheduler.order_longest_first(simFilenames, estimates.get)
+    lptMakespan = _get_makespan(runtimes, order, numCPU)
+
+    print 'Simulated: {0} simulations on {1} cores, estimates +/-{2:.0%}'.format(numSims, numCPU, noise)
+    print '    lower bound   : {0:8.0f} s'.format(lowerBound)
+    print '    FIFO          : {0:8.0f} s ({1:.1%} over)'.format(fifoMakespan, fifoMakespan / lowerBound - 1)
+    print '    longest first : {0:8.0f} s ({1:.1%} over)'.format(lptMakespan, lptMakespan / lowerBound - 1)
+    return fifoMakespan, lptMakespan
+
+FAKE_APSIM = '''import sys, os, time
+sim = sys.argv[1]
+runtimes = dict(line.split() for line in open('runtimes.txt'))
+time.sleep(float(runtimes[sim]))
+sys.stderr.write('100%\\n')
+'''
+
+def benchmark_fake_apsim(numSims=24, numCPU=6, scale=0.01, noise=0.2):
+    ''' Runs numSims simulations of a fake APSIM executable, on numCPU
+    processes, in FIFO and in longest-first order. Runtimes are the
+    simulated runtimes times scale.
+
+    Returns
+    -------
+    Makespans (s) of FIFO and longest-first ordering.
+    '''
+    simFilenames, runtimes = _get_runtimes(numSims)
+    estimates = _get_estimates(runtimes, noise)
+    tempDir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tempDir)
+        with open('fakeApsim.py', 'w') as f:
+            f.write(FAKE_APSIM)
+        with open('runtimes.txt', 'w') as f:
+            for simFilename in simFilenames:
+                f.write('{0} {1}\n'.format(simFilename, runtimes[simFilename] * scale))
+        apsimExePath = [sys.executable, 'fakeApsim.py']
+
+        makespans = []
+        for estimate in (None, estimates.get):
+            for simFilename in simFilenames:
+                open(simFilename, 'w').close()
+            timeOld = time()
+            scheduler.run_sims(simFilenames, apsimExePath, numCPU, estimate=estimate)
+            makespans.append(time() - timeOld)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tempDir)
+
+    fifoMakespan, lptMakespan = makespans
+    print 'Fake APSIM: {0} simulations on {1} processes'.format(numSims, numCPU)
+    print '    FIFO          : {0:6.2f} s'.format(fifoMakespan)
+    print '    longest first : {0:6.2f} s ({1:.2f}x)'.format(lptMakespan, fifoMakespan / lptMakespan)
+    return fifoMakespan, lptMakespan
+
+# Run if module is run as a program
+if __name__ == '__main__':
+    benchmark_simulated()
+    benchmark_fake_apsim()
@@ -4,10 +4,13 @@ Created on Thu Aug 02 14:02:50 2012
 
 @author: David
 """
-import os, csv, glob, sys
+import os, csv, glob, sys, shutil
 from datetime import datetime
+from itertools import imap
+import multiprocessing as mp
 import sqlite3 as lite
 import tarfile
+import numpy as np
 csv.register_dialect('apsim', delimiter=' ', skipinitialspace=True)
 
 class ScrubError(Exception):
@@ -25,9 +28,29 @@ class _Outputfile:
         self.units = units
         self.outputData = outputData
     
+def _to_column(values):
+    ''' Converts a list of strings to a float array if every value is numeric.
+    
+    Parameters
+    ----------
+    values : list
+        string values of one field
+        
+    Returns
+    -------
+    A float array, or a string array if any value is not numeric (ie Date).
+    '''
+    try:
+        return np.array(values, dtype=float)
+    except ValueError:
+        return np.array(values)
+    
 def _read_outputfile(filename):
     ''' Creates an outputfile object by reading a .out file.
     
+    The four header lines are parsed with the 'apsim' csv dialect. The data
+    block is split in bulk and loaded into one NumPy array per field.
+    
     Parameters
     ----------
     filename : string
@@ -60,12 +83,14 @@ def _read_outputfile(filename):
             (blank) ex: None
         
         out.outputData
-            Returns a dictionary with 'fieldName':[value1, value2...] mapping
+            Returns a dictionary with 'fieldName':array([value1, value2...])
+            mapping. Numeric fields are float arrays, others are string arrays.
             
-            ex: {'Date': ['01/01/2000','01/02/2000'], 'yield': ['3500','4000'], 
-                 'maxt': ['39.500','45.385'], 'mint': ['23.500','25.385'],
-                 'rain': ['44','35'], 'radn': ['23','56'], 
-                 'biomass': ['25','45'], 'irr_fasw': ['1.0','0.93']}
+            ex: {'Date': array(['01/01/2000','01/02/2000']),
+                 'yield': array([3500.,4000.]), 'maxt': array([39.5,45.385]),
+                 'mint': array([23.5,25.385]), 'rain': array([44.,35.]),
+                 'radn': array([23.,56.]), 'biomass': array([25.,45.]),
+                 'irr_fasw': array([1.0,0.93])}
             (blank) ex: {}
     '''
     
@@ -77,25 +102,44 @@ def _read_outputfile(filename):
     apsimVersion = None
     
     # read .out file
-    with open(filename) as f:
-        reader = csv.reader(f, dialect='apsim')
-        try:
-            for row in reader:
-                if reader.line_num >= 5: # main data
-                    for field, item in zip(fieldNames, row):
-                        outputData[field].append(item)
-                elif reader.line_num == 1: # apsim version
-                    apsimVersion = ' '.join(row[2:])
-                elif reader.line_num == 2: # title of sim
-                    title = ' '.join(row[2:])
-                elif reader.line_num == 3: # fieldNames
-                    fieldNames = row
-                    for field in row:
-                        outputData[field] = []
-                elif reader.line_num == 4: # units
-                    fieldUnits = row
-        except csv.Error, e:
-            print '*** Warning: {0} contains NULL bytes. Consider re-running simulation. {1}\n'.format(filename, e)
+    with open(filename, 'rU') as f:
+        text = f.read()
+    
+    # keep the lines before any NULL bytes
+    if '\0' in text:
+        print '*** Warning: {0} contains NULL bytes. Consider re-running simulation. line contains NULL byte\n'.format(filename)
+        text = text[:text.rfind('\n', 0, text.index('\0')) + 1]
+    
+    # header
+    lines = text.split('\n', 4)
+    for lineNum, row in enumerate(csv.reader(lines[:4], dialect='apsim'), 1):
+        if lineNum == 1: # apsim version
+            apsimVersion = ' '.join(row[2:])
+        elif lineNum == 2: # title of sim
+            title = ' '.join(row[2:])
+        elif lineNum == 3: # fieldNames
+            fieldNames = row
+        elif lineNum == 4: # units
+            fieldUnits = row
+    
+    # main data
+    if fieldNames != []:
+        # lines that start with a space have an empty first field
+        dataFields = [field for field in fieldNames if field != '']
+        if len(lines) == 5:
+            tokens = lines[4].split()
+        else:
+            tokens = []
+        if len(tokens) % len(dataFields) != 0:
+            # drop incomplete rows (ie simulation ended mid-write)
+            rows = [line.split() for line in lines[4].splitlines()]
+            tokens = [token for row in rows if len(row) == len(dataFields) for token in row]
+        numFields = len(dataFields)
+        
+        for f, field in enumerate(dataFields):
+            outputData[field] = _to_column(tokens[f::numFields])
+        if '' in fieldNames:
+            outputData[''] = np.array([''] * (len(tokens) // numFields))
     
     # create units dictionary
     units = dict(zip(fieldNames,fieldUnits))
@@ -105,12 +149,77 @@ def _read_outputfile(filename):
     
     return outputfile
     
+# date parsers already built, keyed by APSIM date units ex: '(dd/mm/yyyy)'
+_dateParsers = {}
+
+def _get_date_parser(unitsOld):
+    ''' Builds (once per format) what is needed to parse APSIM dates.
+    
+    Parameters
+    ----------
+    unitsOld : string
+        APSIM date formatter ex: '(dd/mm/yyyy)'
+        
+    Returns
+    -------
+    The strptime format and the (start, stop) position of the year, month
+    and day in each date string, or None for the positions if the dates are
+    not fixed width.
+    '''
+    if unitsOld not in _dateParsers:
+        units = unitsOld.strip('(').strip(')')
+        
+        # get unitsOld ready for date parsing
+        dateFormat = units.replace('yyyy','%Y')
+        dateFormat = dateFormat.replace('mm','%m')
+        dateFormat = dateFormat.replace('dd','%d')
+        
+        # character positions of each part in fixed width dates
+        positions = []
+        for part in ('yyyy', 'mm', 'dd'):
+            start = units.find(part)
+            if start == -1 or units.count(part) != 1:
+                positions = None
+                break
+            positions.append((start, start + len(part)))
+        if positions != None:
+            positions = (len(units), positions)
+        
+        _dateParsers[unitsOld] = (dateFormat, positions)
+    
+    return _dateParsers[unitsOld]
+
+def _reorder_dates(datesOld, positions):
+    ''' Rearranges the characters of fixed width dates into yyyy-mm-dd.
+    
+    Returns
+    -------
+    An array of yyyy-mm-dd strings, or None if not every date has the
+    expected width.
+    '''
+    width, parts = positions
+    datesOld = np.asarray(datesOld, dtype=str)
+    if datesOld.dtype.itemsize != width or np.any(np.char.str_len(datesOld) != width):
+        return None
+    
+    chars = datesOld.view('S1').reshape(-1, width)
+    newChars = np.empty((len(datesOld), 10), dtype='S1')
+    newChars[:,4] = newChars[:,7] = '-'
+    for (start, stop), newStart in zip(parts, (0, 5, 8)):
+        newChars[:,newStart:newStart + stop - start] = chars[:,start:stop]
+    return newChars.view('S10').ravel()
+
 def _convert_to_sql_date_format(datesOld, unitsOld):
     ''' Converts APSIM format date to SQL format.
     
+    The whole column is converted at once: the characters of fixed width
+    dates are rearranged into yyyy-mm-dd and checked as a datetime64 array,
+    whatever the reporting frequency. Other columns fall back to parsing
+    each date.
+    
     Parameters
     ----------
-    datesOld : list
+    datesOld : list or numpy array
         list of dates to convert
     
     unitsOld : string
@@ -120,19 +229,28 @@ def _convert_to_sql_date_format(datesOld, unitsOld):
     -------
     Converted dates as a list and date format string used for conversion.
     '''
-    
-    # get unitsOld ready for date parsing
-    unitsOld = unitsOld.strip('(').strip(')')
-    unitsOld = unitsOld.replace('yyyy','%Y')
-    unitsOld = unitsOld.replace('mm','%m')
-    unitsOld = unitsOld.replace('dd','%d')
+    dateFormat, positions = _get_date_parser(unitsOld)
     
     # convert value to SQL compatable format
-    dates = []
-    for i, date in enumerate(datesOld):
-        date = datetime.strptime(date, unitsOld)
-        date = datetime.strftime(date,'%Y-%m-%d')
-        dates.append(date)
+    dates = None
+    if len(datesOld) > 0 and positions != None:
+        newDates = _reorder_dates(datesOld, positions)
+        if newDates is not None:
+            # invalid dates (ie 2001-02-30) raise ValueError or do not
+            # convert back to the same string
+            try:
+                validDates = np.array(newDates, dtype='datetime64[D]')
+            except ValueError:
+                validDates = None
+            if validDates is not None and np.array_equal(validDates.astype('S10'), newDates):
+                dates = newDates.tolist()
+    
+    if dates == None:
+        dates = []
+        for date in datesOld:
+            date = datetime.strptime(date, dateFormat)
+            date = datetime.strftime(date,'%Y-%m-%d')
+            dates.append(date)
     
     # set SQL format for units
     units = '(yyyy-mm-dd)'
@@ -167,11 +285,96 @@ def _get_field_type(field):
     
     return fieldType
     
-def save_output_to_sqlite(filenameList, sqliteFilename='apsimData.sqlite'):
+def _get_output_rows(outputfile, fields):
+    ''' Converts an outputfile to rows for the apsimOutput table.
+    
+    Parameters
+    ----------
+    outputfile : _Outputfile
+        outputfile read by _read_outputfile
+    fields : list
+        field names in the column order of the apsimOutput table
+        
+    Returns
+    -------
+    List of (point_id, value1, value2...) tuples, or None if the .out file
+    is empty.
+    '''
+    if outputfile.outputData == {}: # if the .out file is empty
+        return None
+    
+    # get pointId and append to rows
+    rows = []
+    pointId = int(outputfile.title.split('_')[-1])
+    # get legnth of first data item's list
+    pointIds = [pointId] * len(outputfile.outputData.values()[0])
+    rows.append(pointIds)
+    
+    for field in fields:
+        unit = outputfile.units[field]
+        # convert Date units to SQL compatable format
+        if (field == 'date' or field == 'Date') and unit != '(yyyy-mm-dd)':
+            values, unit = _convert_to_sql_date_format(outputfile.outputData[field], unit)
+        else:
+            values = outputfile.outputData[field].tolist()
+        rows.append(values)
+        
+    return zip(*rows)
+
+def _read_output_rows(args):
+    ''' Reads a .out file and converts it to rows for the apsimOutput table.
+    Used by the worker processes of save_output_to_sqlite.
+    
+    Parameters
+    ----------
+    args : tuple
+        (filename, fields) where fields are the field names in the column
+        order of the apsimOutput table
+        
+    Returns
+    -------
+    The rows from _get_output_rows.
+    '''
+    filename, fields = args
+    return _get_output_rows(_read_outputfile(filename), fields)
+
+def _insert_output_rows(conn, sql, rows, deleteSql=None):
+    ''' Inserts rows into the apsimOutput table in one transaction, after
+    running deleteSql (if any) for the point_id of each point in rows.'''
+    with conn:
+        if deleteSql != None:
+            conn.executemany(deleteSql, [(pointId,) for pointId in set(row[0] for row in rows)])
+        conn.executemany(sql, rows)
+
+def _replace_file(filename, destination):
+    ''' Renames filename to destination, replacing destination if it exists
+    (os.rename does not on Windows).'''
+    try:
+        os.rename(filename, destination)
+    except OSError:
+        if not os.path.isfile(destination):
+            raise
+        os.remove(destination)
+        os.rename(filename, destination)
+
+def save_output_to_sqlite(filenameList, sqliteFilename='apsimData.sqlite', numCPU=1, batchsize=100000,
+                          append=False, removePointIds=()):
     ''' Save all .out files in current directory to sqlite database file
     with sqliteFilename.
     
-    Deletes any previous database.
+    The database is written to sqliteFilename + '.new' and then replaces
+    any previous database, so a save that is interrupted leaves the previous
+    database as it was. With append, the new database starts as a copy of
+    the previous one and the rows of the points in filenameList replace any
+    rows already saved for those points (ie when ApsimRun resumes a run).
+    The rows of the points in removePointIds are deleted first (ie points
+    of an .apsim file that changed since they were saved).
+    
+    With numCPU > 1, the .out files are read and converted by a pool of
+    worker processes while this process is the only one writing to the
+    database. Rows are written in transactions of batchsize rows with
+    journal_mode=WAL and synchronous=OFF, so the number of commits does not
+    grow with the number of files.
     
     Parameters
     ----------
@@ -179,6 +382,16 @@ def save_output_to_sqlite(filenameList, sqliteFilename='apsimData.sqlite'):
         list of .out filenames
     sqliteFilename : string
         (optional) output filename of sqlite database
+    numCPU : int
+        (optional) number of processes used to read .out files
+    batchsize : int
+        (optional) number of rows written per transaction
+    append : bool
+        (optional) add to the previous database, if any, instead of
+        replacing it
+    removePointIds : list
+        (optional) point ids whose rows are deleted from the previous
+        database when appending
         
     Returns
     -------
@@ -191,27 +404,49 @@ def save_output_to_sqlite(filenameList, sqliteFilename='apsimData.sqlite'):
     
     # set first outputTableName column header as primary key
     headerList = ['`point_id` integer']
+    fields = []
+    unitsRows = []
+    
+    # delete what is left of an interrupted save, if any
+    newFilename = sqliteFilename + '.new'
+    for filename in (newFilename, newFilename + '-wal', newFilename + '-shm'):
+        if os.path.isfile(filename):
+            os.remove(filename)
+    
+    # start from a copy of the previous database, keeping its fields
+    append = append and os.path.isfile(sqliteFilename)
+    if append:
+        shutil.copyfile(sqliteFilename, newFilename)
+        conn = lite.connect(newFilename)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(" + outputTableName + ")")]
+        conn.close()
+        for field in columns[1:]:
+            headerList.append('`' + field + '` ' + _get_field_type(field))
+            fields.append(field)
     
     # get field and units information from first .out file that is not empty
-    for filename in filenameList:
+    # and keep it so it is not read again
+    firstRows = None
+    for first, filename in enumerate(filenameList):
         outputfile = _read_outputfile(filename)
         if outputfile.outputData != {}:
-            for field, unit in outputfile.units.iteritems():
-                fieldType = _get_field_type(field)
-                headerList.append('`' + field + '` ' + fieldType)
+            if fields == []:
+                for field, unit in outputfile.units.iteritems():
+                    fieldType = _get_field_type(field)
+                    headerList.append('`' + field + '` ' + fieldType)
+                    fields.append(field)
             # set units to save
             unitsRows = outputfile.units.items()
+            firstRows = _get_output_rows(outputfile, fields)
             break
     
     # define outputTableName column headers
     headerLine = ','.join(headerList)
-    
-    # delete previous database, if any
-    if os.path.isfile(sqliteFilename):
-        os.remove(sqliteFilename)
         
     # open database
-    conn = lite.connect(sqliteFilename)     
+    conn = lite.connect(newFilename)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
     with conn:
         # create table if it doesn't exist
         try:
@@ -221,35 +456,49 @@ def save_output_to_sqlite(filenameList, sqliteFilename='apsimData.sqlite'):
             raise
         sql = "CREATE TABLE IF NOT EXISTS "+outputTableName+" ("+headerLine+")"
         conn.execute(sql)
-        
+    
+    valuesPlaceholder = ','.join('?' * len(headerList))
+    sql = "INSERT INTO " + outputTableName + " VALUES (" + valuesPlaceholder + ")"
+    
+    # index the rows of each point, as masterRunDb reads them by point
+    # and date and parallel reads store them out of order. When appending,
+    # the index is needed first to replace the rows of a point.
+    indexColumns = ['`point_id`'] + ['`' + field + '`' for field in fields if field.lower() == 'date']
+    indexSql = "CREATE INDEX IF NOT EXISTS " + outputTableName + "_point ON " + outputTableName + " (" + ', '.join(indexColumns) + ")"
+    if append:
+        deleteSql = "DELETE FROM " + outputTableName + " WHERE point_id=?"
+        with conn:
+            conn.execute(indexSql)
+            conn.executemany(deleteSql, [(pointId,) for pointId in removePointIds])
+    else:
+        deleteSql = None
+    
     # read .out files and save to sqldatabase
-    for filename in filenameList:
-        outputfile = _read_outputfile(filename)
-        if outputfile.outputData == {}: # if the .out file is empty
-            continue
-        
-        # get pointId and append to rows
-        rows = []
-        pointId = int(outputfile.title.split('_')[-1])
-        # get legnth of first data item's list
-        pointIds = [pointId] * len(outputfile.outputData.values()[0])
-        rows.append(pointIds)
+    if firstRows != None:
+        jobs = [(filename, fields) for filename in filenameList[first + 1:]]
+        if numCPU > 1 and len(jobs) > 1:
+            pool = mp.Pool(numCPU)
+            results = pool.imap_unordered(_read_output_rows, jobs, chunksize=8)
+        else:
+            pool = None
+            results = imap(_read_output_rows, jobs)
         
-        for field, unit in outputfile.units.iteritems():
-            # convert Date units to SQL compatable format
-            if (field == 'date' or field == 'Date') and unit != '(yyyy-mm-dd)':
-                values, unit = _convert_to_sql_date_format(outputfile.outputData[field], unit)
-            else:
-                values = outputfile.outputData[field]
-            rows.append(values)
-            
-        rows = zip(*rows)
-    
-        # save data to SQLite database
+        batch = list(firstRows)
+        for rows in results:
+            if rows == None: # if the .out file is empty
+                continue
+            batch.extend(rows)
+            if len(batch) >= batchsize:
+                _insert_output_rows(conn, sql, batch, deleteSql)
+                batch = []
+        _insert_output_rows(conn, sql, batch, deleteSql)
+
+        if pool != None:
+            pool.close()
+            pool.join()
+
         with conn:
-            valuesPlaceholder = ','.join('?' * len(headerList))
-            sql = "INSERT INTO " + outputTableName + " VALUES (" + valuesPlaceholder + ")"
-            conn.executemany(sql, rows)
+            conn.execute(indexSql)
     
     # save fields table to SQLite database
     with conn:
@@ -263,15 +512,26 @@ def save_output_to_sqlite(filenameList, sqliteFilename='apsimData.sqlite'):
         conn.execute(sql)
         
         # insert fields into table
-        sql = "INSERT INTO " + fieldTableName + " VALUES (?,?)"
+        sql = "INSERT OR REPLACE INTO " + fieldTableName + " VALUES (?,?)"
         conn.executemany(sql, unitsRows)
+    
+    # leave a single database file (no -wal file) for archiving and copying
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+    _replace_file(newFilename, sqliteFilename)
         
     print sqliteFilename, 'saved to', os.getcwd()
     
-def save_output_to_archive(outputFilenameList, filenameOut='apsimData.tar', compression='gz'):
+def save_output_to_archive(outputFilenameList, filenameOut='apsimData.tar', compression='gz',
+                           append=False, removeFilenames=()):
     ''' Save files in outputFilenameList in current directory to a .tar archive
     named filenameOut, overwriting any previously created archive.
     
+    The archive is written to filenameOut + '.new' and then replaces any
+    previous archive. With append, the files of the previous archive that
+    are not in outputFilenameList or removeFilenames are copied to the new
+    archive first.
+    
     Parameters
     ----------
     outputFilenameList : list
@@ -280,6 +540,10 @@ def save_output_to_archive(outputFilenameList, filenameOut='apsimData.tar', comp
         (optional) Filename of tar archive to be saved
     compression : string
         (optional) Type of compression. Either 'None', 'gz' (gzip), or 'bz2' (bzip2).
+    append : bool
+        (optional) keep the files of the previous archive, if any
+    removeFilenames : list
+        (optional) files of the previous archive not to keep when appending
         
     Returns
     -------
@@ -292,17 +556,27 @@ def save_output_to_archive(outputFilenameList, filenameOut='apsimData.tar', comp
     else:
         mode = 'w:{0}'.format(compression)
         filenameOut = filenameOut + '.{0}'.format(compression)
+    newFilename = filenameOut + '.new'
         
     # add file to archive
     numJobs = len(outputFilenameList)
     prevPrint = 0
-    with tarfile.open(filenameOut, mode=mode) as tar:
+    with tarfile.open(newFilename, mode=mode) as tar:
+        if append and os.path.isfile(filenameOut):
+            # files of the previous archive, except those saved again or
+            # removed
+            names = set(outputFilenameList) | set(removeFilenames)
+            with tarfile.open(filenameOut, mode='r:*') as prevTar:
+                for member in prevTar:
+                    if member.name not in names:
+                        tar.addfile(member, prevTar.extractfile(member))
         for counter, outputFilename in enumerate(outputFilenameList):
             percComplete = int(round(float(counter) / numJobs * 100,1))
             if percComplete in xrange(5,101,5) and percComplete != prevPrint:
                 print '{0}%'.format(percComplete)
                 prevPrint = percComplete
             tar.add(outputFilename)
+    _replace_file(newFilename, filenameOut)
     print filenameOut, 'saved to', os.getcwd()
     
 def main(args):
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the .out file processing in utils.py.
+
+Ex: python utilsBenchmark.py [numFiles]
+"""
+import os, csv, sys, shutil, tempfile
+from time import time
+from datetime import date, timedelta
+from datetime import datetime
+import numpy as np
+import multiprocessing as mp
+import utils
+
+def _read_outputfile_csv(filename):
+    ''' Reads a .out file the way utils._read_outputfile did before it was
+    vectorized (csv module, one string per value). Kept for comparison.'''
+    outputData = {}
+    fieldNames = []
+    with open(filename) as f:
+        reader = csv.reader(f, dialect='apsim')
+        for row in reader:
+            if reader.line_num >= 5: # main data
+                for field, item in zip(fieldNames, row):
+                    outputData[field].append(item)
+            elif reader.line_num == 3: # fieldNames
+                fieldNames = row
+                for field in row:
+                    outputData[field] = []
+    return outputData
+
+def _write_outputfiles(outputDir, numFiles, numYears):
+    ''' Writes numFiles .out files of random daily data for numYears years.
+    
+    Returns
+    -------
+    List of .out filenames.
+    '''
+    startDate = date(1991, 1, 1)
+    numDays = (date(1991 + numYears, 1, 1) - startDate).days
+    dates = [(startDate + timedelta(days=d)).strftime('%d/%m/%Y') for d in range(numDays)]
+    filenameList = []
+    for n in range(numFiles):
+        filename = os.path.join(outputDir, 'NARR32_maize_{0:05d}.out'.format(n))
+        values = np.random.uniform(0, 1000, (numDays, 8))
+        with open(filename, 'w') as f:
+            f.write('ApsimVersion = 7.4\n')
+            f.write('Title = NARR32_maize_{0:05d}\n'.format(n))
+            f.write('Date yield biomass lai rain mint maxt radn irr_fasw\n')
+            f.write('(dd/mm/yyyy) (kg/ha) (kg/ha) () (mm) (oC) (oC) (MJ/m^2) (0-1)\n')
+            for day, row in zip(dates, values):
+                f.write(day + ' ' + ' '.join('{0:.3f}'.format(value) for value in row) + '\n')
+        filenameList.append(filename)
+    return filenameList
+
+def benchmark_read_outputfile(numFiles=1000, numYears=20):
+    ''' Times utils._read_outputfile against the csv based reader on numFiles
+    daily .out files of numYears years, and checks they read the same values.
+    
+    Parameters
+    ----------
+    numFiles : int
+        (optional) number of .out files
+    numYears : int
+        (optional) number of years of daily output in each file
+    
+    Returns
+    -------
+    Runtimes (s) of the csv based reader and of utils._read_outputfile.
+    '''
+    outputDir = tempfile.mkdtemp()
+    try:
+        print 'Writing {0} .out files...'.format(numFiles)
+        filenameList = _write_outputfiles(outputDir, numFiles, numYears)
+        
+        timeOld = time()
+        for filename in filenameList:
+            _read_outputfile_csv(filename)
+        csvRuntime = time() - timeOld
+        
+        timeOld = time()
+        for filename in filenameList:
+            utils._read_outputfile(filename)
+        runtime = time() - timeOld
+        
+        # check that both readers agree on the last file
+        outputData = _read_outputfile_csv(filenameList[-1])
+        outputfile = utils._read_outputfile(filenameList[-1])
+        for field, values in outputData.iteritems():
+            if field == 'Date':
+                assert list(outputfile.outputData[field]) == values
+            else:
+                assert np.allclose(outputfile.outputData[field], np.array(values, dtype=float))
+    finally:
+        shutil.rmtree(outputDir)
+    
+    print 'csv reader        : {0:.2f} s'.format(csvRuntime)
+    print '_read_outputfile  : {0:.2f} s ({1:.1f}x)'.format(runtime, csvRuntime / runtime)
+    return csvRuntime, runtime
+
+def benchmark_convert_to_sql_date_format(numYears=20, repeat=10):
+    ''' Times utils._convert_to_sql_date_format against a strptime/strftime
+    loop on one column of numYears years of daily dates.
+    
+    Returns
+    -------
+    Runtimes (s) of the loop and of utils._convert_to_sql_date_format.
+    '''
+    startDate = date(1991, 1, 1)
+    numDays = (date(1991 + numYears, 1, 1) - startDate).days
+    datesOld = np.array([(startDate + timedelta(days=d)).strftime('%d/%m/%Y') for d in range(numDays)])
+    
+    timeOld = time()
+    for _ in range(repeat):
+        loopDates = [datetime.strptime(d, '%d/%m/%Y').strftime('%Y-%m-%d') for d in datesOld]
+    loopRuntime = (time() - timeOld) / repeat
+    
+    timeOld = time()
+    for _ in range(repeat):
+        dates, units = utils._convert_to_sql_date_format(datesOld, '(dd/mm/yyyy)')
+    runtime = (time() - timeOld) / repeat
+    assert dates == loopDates
+    
+    print 'strptime loop               : {0:.2f} ms'.format(loopRuntime * 1000)
+    print '_convert_to_sql_date_format : {0:.2f} ms ({1:.1f}x)'.format(runtime * 1000, loopRuntime / runtime)
+    return loopRuntime, runtime
+
+def benchmark_save_output_to_sqlite(numFiles=500, numYears=20, numCPU=None):
+    ''' Times utils.save_output_to_sqlite on numFiles .out files, reading
+    them in this process and then with a pool of numCPU processes.
+    
+    Returns
+    -------
+    Runtimes (s) with one process and with numCPU processes.
+    '''
+    if numCPU == None:
+        numCPU = mp.cpu_count()
+    outputDir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(outputDir)
+        filenameList = [os.path.basename(filename) for filename in _write_outputfiles(outputDir, numFiles, numYears)]
+        
+        timeOld = time()
+        utils.save_output_to_sqlite(filenameList, numCPU=1)
+        serialRuntime = time() - timeOld
+        
+        timeOld = time()
+        utils.save_output_to_sqlite(filenameList, numCPU=numCPU)
+        runtime = time() - timeOld
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(outputDir)
+    
+    print 'save_output_to_sqlite, 1 process   : {0:.2f} s'.format(serialRuntime)
+    print 'save_output_to_sqlite, {0} processes : {1:.2f} s ({2:.1f}x)'.format(numCPU, runtime, serialRuntime / runtime)
+    return serialRuntime, runtime
+
+# Run if module is run as a program
+if __name__ == '__main__':
+    if len(sys.argv) == 2:
+        benchmark_read_outputfile(int(sys.argv[1]))
+    else:
+        benchmark_read_outputfile()
+    benchmark_convert_to_sql_date_format()
+    benchmark_save_output_to_sqlite()
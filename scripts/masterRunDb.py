@@ -4,14 +4,88 @@
 # main file for creating a database of all the experiments' runs
 #==============================================================================
 
-import os
+import os, hashlib
 import numpy as np
 import pandas
 from pandas.io import sql as psql
 from time import strptime
-from math import floor
+from itertools import chain, groupby, izip
+from operator import itemgetter
 import sqlite3 as lite
-from apsimRegions.preprocess import fileio
+import multiprocessing as mp
+from apsimRegions.preprocess import fileio, gridlut
+
+# version of the master run database schema (PRAGMA user_version). Databases
+# with an older version are upgraded by migrate_schema().
+SCHEMA_VERSION = 1
+OUTPUT_FIELDS_SQL = "CREATE TABLE outputFields (name TEXT PRIMARY KEY, units TEXT)"
+RUN_FINGERPRINTS_SQL = "CREATE TABLE runFingerprints (run_id INTEGER PRIMARY KEY, config_size INTEGER, config_mtime REAL, config_hash TEXT, data_size INTEGER, data_mtime REAL, data_hash TEXT)"
+
+def _get_sql_type(dtype):
+    '''Returns the SQLite column type for a numpy dtype.'''
+    if dtype.kind in 'iub':
+        return 'INTEGER'
+    elif dtype.kind == 'f':
+        return 'REAL'
+    else:
+        return 'TEXT'
+    
+def _get_grid_points_schema(columns):
+    '''
+    Creates the SQL for the gridPoints table.
+    
+    Parameters
+    ----------
+    columns : list
+        (name, type) of each column. point_id is made the primary key.
+    
+    Returns
+    -------
+    SQL statement to create the table.
+    '''
+    columnDefs = ['`point_id` INTEGER PRIMARY KEY']
+    columnDefs += ['`{0}` {1}'.format(name, columnType) for name, columnType in columns if name != 'point_id']
+    
+    return "CREATE TABLE gridPoints (" + ', '.join(columnDefs) + ")"
+    
+def _get_apsim_output_schema(columns):
+    '''
+    Creates the SQL for the apsimOutput table and its indexes.
+    
+    Rows are keyed by (run_id, point_id, sow_year). harvest_date is TEXT and
+    every other field is a REAL seasonal value. The table is created WITHOUT
+    ROWID when SQLite supports it (3.8.2 and later), so rows are stored in
+    primary key order.
+    
+    Parameters
+    ----------
+    columns : list
+        column names of the yearly apsim output
+    
+    Returns
+    -------
+    SQL statement to create the table and a list of SQL statements to create
+    its indexes.
+    '''
+    keyColumns = ['run_id', 'point_id', 'sow_year']
+    columnDefs = ['`{0}` INTEGER NOT NULL'.format(name) for name in keyColumns]
+    for name in columns:
+        if name in keyColumns:
+            continue
+        elif name == 'harvest_date':
+            columnDefs.append('`{0}` TEXT'.format(name))
+        else:
+            columnDefs.append('`{0}` REAL'.format(name))
+    columnDefs.append('PRIMARY KEY (run_id, point_id, sow_year)')
+    
+    sql = "CREATE TABLE apsimOutput (" + ', '.join(columnDefs) + ")"
+    if lite.sqlite_version_info >= (3, 8, 2):
+        sql += " WITHOUT ROWID"
+    
+    indexSqls = ["CREATE INDEX IF NOT EXISTS apsimOutput_point_id ON apsimOutput (point_id, sow_year)",
+                 "CREATE INDEX IF NOT EXISTS apsimOutput_sow_year ON apsimOutput (sow_year, run_id)"]
+    
+    return sql, indexSqls
 
 def create_tables(masterDbConn, gridLut):
     '''
@@ -21,7 +95,7 @@ def create_tables(masterDbConn, gridLut):
     ----------
     masterDbConn : sqlite connection object
         master database to connect to
-    gridLut : pandas dataframe
+    gridLut : GridLut object from gridlut module (or pandas dataframe)
         contains the grid information (point_id, lat, lon, county, etc.)
     
     Returns
@@ -34,13 +108,172 @@ def create_tables(masterDbConn, gridLut):
         masterDbConn.execute(sql)
         
         # create apsimOutput table
-        # handeled in update_apsim_output_table()
+        # handeled in _insert_apsim_output(), as its columns depend on the
+        # output fields of the runs
         
         # create outputFields table
-        # handeled in update_output_fields_table()
+        masterDbConn.execute(OUTPUT_FIELDS_SQL)
+        
+        # create runFingerprints table
+        masterDbConn.execute(RUN_FINGERPRINTS_SQL)
         
         # create gridPoints table
-        psql.write_frame(gridLut, 'gridPoints', masterDbConn)
+        columns = [(name, _get_sql_type(gridLut[name].dtype)) for name in gridLut.columns]
+        masterDbConn.execute(_get_grid_points_schema(columns))
+        columnNames = ', '.join('`{0}`'.format(name) for name in gridLut.columns)
+        valuesPlaceholder = ','.join('?' * len(gridLut.columns))
+        sql = "INSERT INTO gridPoints (" + columnNames + ") VALUES (" + valuesPlaceholder + ")"
+        masterDbConn.executemany(sql, izip(*[gridLut[name].tolist() for name in gridLut.columns]))
+        
+        masterDbConn.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+    
+def migrate_schema(masterDbConn):
+    '''
+    Upgrades a master run database created by an older version of this
+    script to the current schema, as one transaction.
+    
+    The gridPoints, outputFields and apsimOutput tables written by
+    pandas.io.sql.write_frame are rebuilt with primary keys, explicit column
+    types and indexes, and the runFingerprints table is added.
+    
+    Parameters
+    ----------
+    masterDbConn : sqlite connection object
+        master database to connect to
+    
+    Returns
+    -------
+    Nothing.
+    '''
+    version = masterDbConn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    
+    print 'Migrating master run database to schema version {0}...'.format(SCHEMA_VERSION)
+    sqls = [RUN_FINGERPRINTS_SQL.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS')]
+    
+    if _table_exists(masterDbConn, 'gridPoints'):
+        columns = [(row[1], row[2]) for row in masterDbConn.execute("PRAGMA table_info(gridPoints)")]
+        columnNames = ', '.join('`{0}`'.format(name) for name, columnType in columns)
+        sqls += ["ALTER TABLE gridPoints RENAME TO gridPoints_old",
+                 _get_grid_points_schema(columns),
+                 "INSERT INTO gridPoints (" + columnNames + ") SELECT " + columnNames + " FROM gridPoints_old",
+                 "DROP TABLE gridPoints_old"]
+    
+    if _table_exists(masterDbConn, 'outputFields'):
+        sqls += ["ALTER TABLE outputFields RENAME TO outputFields_old",
+                 OUTPUT_FIELDS_SQL,
+                 "INSERT OR IGNORE INTO outputFields SELECT name, units FROM outputFields_old",
+                 "DROP TABLE outputFields_old"]
+    else:
+        sqls.append(OUTPUT_FIELDS_SQL)
+    
+    if _table_exists(masterDbConn, 'apsimOutput'):
+        columns = [row[1] for row in masterDbConn.execute("PRAGMA table_info(apsimOutput)")]
+        columnNames = ', '.join('`{0}`'.format(name) for name in columns)
+        sql, indexSqls = _get_apsim_output_schema(columns)
+        sqls += ["ALTER TABLE apsimOutput RENAME TO apsimOutput_old",
+                 sql,
+                 "INSERT OR REPLACE INTO apsimOutput (" + columnNames + ") SELECT " + columnNames + " FROM apsimOutput_old",
+                 "DROP TABLE apsimOutput_old"]
+        sqls += indexSqls
+    
+    # the sqlite3 module commits before each CREATE, ALTER or DROP statement,
+    # so the transaction is managed here. The schema version is only set
+    # once every table has been copied, and nothing is kept on an error.
+    masterDbConn.commit()
+    isolationLevel = masterDbConn.isolation_level
+    masterDbConn.isolation_level = None
+    try:
+        masterDbConn.execute("BEGIN")
+        try:
+            for sql in sqls:
+                masterDbConn.execute(sql)
+            masterDbConn.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+            masterDbConn.execute("COMMIT")
+        except:
+            masterDbConn.execute("ROLLBACK")
+            raise
+    finally:
+        masterDbConn.isolation_level = isolationLevel
+    
+def _table_exists(dbConn, tableName):
+    '''Checks if tableName exists in the database.'''
+    sql = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+    return dbConn.execute(sql, (tableName,)).fetchone() is not None
+    
+def _hash_file(path, blocksize=2**20):
+    '''Returns the md5 hash of a file, read blocksize bytes at a time.'''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            md5.update(block)
+    return md5.hexdigest()
+    
+def _get_file_fingerprint(path, stored=None):
+    '''
+    Gets the fingerprint of a file.
+    
+    Parameters
+    ----------
+    path : string
+        path to file
+    stored : tuple
+        (optional) previously recorded (size, mtime, hash) of the file. The
+        file is only hashed again if its size or mtime have changed.
+    
+    Returns
+    -------
+    Tuple of the file's size, modification time and md5 hash.
+    '''
+    stat = os.stat(path)
+    if stored is not None and tuple(stored[:2]) == (stat.st_size, stat.st_mtime):
+        return tuple(stored)
+    
+    return (stat.st_size, stat.st_mtime, _hash_file(path))
+    
+def get_run_fingerprint(masterDbConn, runPath):
+    '''
+    Gets the fingerprint of a run's config.ini and apsimData.sqlite and
+    checks it against the one recorded in the runFingerprints table.
+    
+    Parameters
+    ----------
+    masterDbConn : sqlite connection object
+        master database to connect to
+    runPath : string
+        path to the run folder
+    
+    Returns
+    -------
+    The fingerprint (config size, mtime and hash, then data size, mtime and
+    hash) and if the run is new or has changed (True) or not (False).
+    '''
+    runId = int(os.path.split(runPath)[1])
+    configPath = os.path.join(runPath, 'config.ini')
+    apsimDbPath = os.path.join(runPath, 'data', 'apsimData.sqlite')
+    
+    sql = "SELECT config_size, config_mtime, config_hash, data_size, data_mtime, data_hash FROM runFingerprints WHERE run_id=?"
+    stored = masterDbConn.execute(sql, (runId,)).fetchone()
+    if stored is None:
+        fingerprint = _get_file_fingerprint(configPath) + _get_file_fingerprint(apsimDbPath)
+        return fingerprint, True
+    
+    fingerprint = _get_file_fingerprint(configPath, stored[:3]) + _get_file_fingerprint(apsimDbPath, stored[3:])
+    changed = (fingerprint[2], fingerprint[5]) != (stored[2], stored[5])
+    
+    # files touched but not changed; record new mtimes so they aren't hashed
+    # again next time
+    if not changed and fingerprint != tuple(stored):
+        with masterDbConn:
+            _save_run_fingerprint(masterDbConn, runId, fingerprint)
+    
+    return fingerprint, changed
+    
+def _save_run_fingerprint(masterDbConn, runId, fingerprint):
+    '''Records the fingerprint of a run in the runFingerprints table.'''
+    sql = "INSERT OR REPLACE INTO runFingerprints VALUES (?, ?, ?, ?, ?, ?, ?)"
+    masterDbConn.execute(sql, (runId,) + tuple(fingerprint))
         
 def update_run_parameters_table(masterDbConn, configPath):
     '''
@@ -83,127 +316,145 @@ def update_run_parameters_table(masterDbConn, configPath):
     
     return update
 
-def _get_yearly_yield(pointDailyData):
+def _get_harvests(pointIds, dates, yields):
     '''
-    Determines yield values by year when given daily point data.
+    Determines yield values by year for many points at once.
+    
+    Each year's crop cycle starts on 1 January, or on the day after the
+    previous crop was harvested when that crop was still in the ground on
+    31 December. Season peaks and harvest dates are found for all
+    (point, year) cycles with grouped NumPy reductions instead of per-day
+    date lookups.
     
     Parameters
     ----------
-    pointDailyData : pandas TimeSeries
-        point daily yield values, indexed by date
+    pointIds : numpy array
+        point id of each row
+    dates : numpy array
+        date of each row (datetime64)
+    yields : numpy array
+        daily yield of each row
+    
+    Rows must be sorted by point id and then date.
     
     Returns
     -------
-    Dataframe of yearly yield data (yield and harvest_date).
+    Dataframe of yearly yield data (point_id, sow_year, yield and
+    harvest_date).
     '''
-    # get unique years from data
-    years = np.unique(pointDailyData.index.year)
+    pointIds = np.asarray(pointIds)
+    days = np.asarray(dates).astype('datetime64[D]')
+    yields = np.asarray(yields, dtype=float)
+    years = days.astype('datetime64[Y]').astype(int) + 1970
+    numRows = len(days)
+    rows = np.arange(numRows)
+    
+    # group rows into (point, year) crop cycles
+    newGroup = np.ones(numRows, dtype=bool)
+    newGroup[1:] = (pointIds[1:] != pointIds[:-1]) | (years[1:] != years[:-1])
+    groupStart = np.flatnonzero(newGroup)
+    groupEnd = np.append(groupStart[1:] - 1, numRows - 1)
+    groupId = np.cumsum(newGroup) - 1
+    groupYears = years[groupStart]
+    firstOfPoint = np.ones(len(groupStart), dtype=bool)
+    firstOfPoint[1:] = pointIds[groupStart[1:]] != pointIds[groupStart[:-1]]
+    
+    # years without a value on 31 December (simulation ended early) are
+    # set as NaN
+    yearEnds = (groupYears + 1 - 1970).astype('datetime64[Y]').astype('datetime64[D]') - 1
+    missing = days[groupEnd] != yearEnds
+    for g in np.flatnonzero(missing):
+        print '*** Warning: {e} out of simulation range. Setting year {year} as NaN. Likely due to previous year crop still in ground or simulation ending early.'.format(e=yearEnds[g], year=groupYears[g])
+        print '***** Work around: use management rule "end_crop_on_fixed_date_rule" in each APSIM simulation to end the crop at least 2 days before sowing.'
+    
+    # a crop still in the ground on 31 December keeps growing until the
+    # first day its yield drops (harvest). The end of a point or a missing
+    # day means the simulation never completed the crop.
+    noData = np.ones(numRows, dtype=bool)
+    noData[:-1] = (pointIds[1:] != pointIds[:-1]) | (days[1:] - days[:-1] != np.timedelta64(1, 'D'))
+    drop = np.zeros(numRows, dtype=bool)
+    drop[:-1] = yields[1:] < yields[:-1]
+    events = np.flatnonzero(noData | drop)
+    stop = events[np.searchsorted(events, groupEnd)]
+    lastValue = yields[groupEnd]
+    overlap = lastValue > 0
+    
+    # start of each crop cycle
+    cycleStart = groupStart.copy()
+    carry = np.flatnonzero(~firstOfPoint[1:] & overlap[:-1]) + 1
+    cycleStart[carry] = stop[carry - 1] + 1
+    emptyCycle = cycleStart > groupEnd
+    
+    # season peak and the last day the peak was reached
+    inCycle = rows >= cycleStart[groupId]
+    cycleMax = np.fmax.reduceat(np.where(inCycle, yields, np.nan), groupStart)
+    isPeak = inCycle & (yields == cycleMax[groupId])
+    peakRow = np.maximum.reduceat(np.where(isPeak, rows, -1), groupStart)
+    
+    # yield and harvest date of each cycle
+    yearlyYield = np.where(lastValue == 0, cycleMax, np.nan)
+    harvestRow = np.where((lastValue == 0) & (cycleMax != 0), peakRow, -1)
+    yearlyYield = np.where(cycleMax == 0, 0.0, yearlyYield)
+    runEnd = overlap & (cycleMax != 0)
+    yearlyYield = np.where(runEnd & ~noData[stop], yields[stop], yearlyYield)
+    # harvest date is only known once the yield has grown past 31 December
+    harvestRow = np.where(runEnd & ~noData[stop] & (stop > groupEnd), stop, harvestRow)
+    yearlyYield[emptyCycle | missing] = np.nan
+    harvestRow[emptyCycle | missing] = -1
+    
+    harvestDates = np.empty(len(groupStart), dtype=object)
+    harvestDates[:] = np.nan
+    harvested = harvestRow >= 0
+    harvestDates[harvested] = np.datetime_as_string(days[harvestRow[harvested]])
+    
+    # years where the daily data fits no case are left out
+    valid = (cycleMax == 0) | (lastValue >= 0) | emptyCycle | missing
+    for year in groupYears[~valid]:
+        print '*** Warning: no case for daily data for year {}'.format(year)
+    
+    yearlyYieldData = pandas.DataFrame({'point_id':pointIds[groupStart],
+                                        'sow_year':groupYears,
+                                        'yield':yearlyYield,
+                                        'harvest_date':harvestDates})
+    
+    return yearlyYieldData[valid]
+
+def _get_output_fields(apsimDbConn):
+    '''
+    Reads the field names from the outputFields table.
     
-    yearlyYield = {}
-    harvestDates = {}
-    startDay = pandas.datetime(years[0],1,1)
-    yearOverlap = False
-    for year in years:
-        # check to see if previous year overlaps with this one
-        # if it does use the harvest day as start
-        if yearOverlap:
-            rng = pandas.date_range(startDay, '12/31/{}'.format(year))
-        else:
-            rng = pandas.date_range('1/1/{}'.format(year), '12/31/{}'.format(year))
-        
-        # get the max yield for the year and the value on 12/31/{year}
-        yearMax = float(pointDailyData.ix[rng].max())
-        try:
-            yearLastValue = float(pointDailyData.ix[rng[-1]])
-        except KeyError as e:
-            # special case where previous year's crop is still in ground
-            # set current year as NaN and break loop (no more year data)
-            print '*** Warning: {e} out of simulation range. Setting year {year} as NaN. Likely due to previous year crop still in ground.'.format(e=e, year=year)
-            print '***** Work around: use management rule "end_crop_on_fixed_date_rule" in each APSIM simulation to end the crop at least 2 days before sowing.'
-            yearlyYield[year] = np.nan
-            harvestDates[year] = np.nan
-            raise
-            # TODO: BUG (#127)
-            # If the chunksize is set to be a static value from the first data
-            # point, there is a chance that if there are points where the 
-            # simulation abruptly ended, then the chunksizes would be
-            # inaccurate from that point forward. Fix this.
-            #
-            # In cases where the apsim simulation failed to complete, this
-            # will cause problems; as when the crop cannot be planted again
-            # due to it already existing in the ground.
-            #
-            # Workaround: delete offending point from the database after
-            # the fact.
-            break
+    Parameters
+    ----------
+    apsimDbConn : sqlite connection object
+        connection to database
         
-        # if all values are 0 for a given year
-        if yearMax == 0:
-            yearlyYield[year] = 0
-            harvestDates[year] = np.nan
-            yearOverlap = False
-        # if the last day of the year is 0
-        elif yearLastValue == 0:
-            yearlyYield[year] = yearMax
-            # get timestamp of last possible day that matches yieldMax
-            harvestDates[year] = pointDailyData.ix[rng][pointDailyData.ix[rng] == yearMax].tail(1).index[0].strftime('%Y-%m-%d')
-            yearOverlap = False
-        # if the yield is > 0 on the last day of the year
-        elif yearLastValue > 0:
-            check = True
-            yearOverlap = True
-            yearlyYield[year] = yearLastValue
-            day = rng[-1]
-            while check:
-                # get the crop yield for the next day
-                day += pandas.DateOffset(1)
-                
-                # if the date is out of the simulation period 
-                # (simulation never completed) then set as NaN
-                try:
-                    cropYieldNew = float(pointDailyData.ix[day])
-                except KeyError as e:
-                    # will always happen for the last year of the simulation
-                    #print '*** Warning: {e} out of simulation range. Setting year {year} as NaN.'.format(e=e, year=year)
-                    yearlyYield[year] = np.nan
-                    harvestDates[year] = np.nan
-                    cropYieldNew = 0.0
-                    check = False
-                    
-                # check to see if new value is >= preveous day's value
-                # if it is, set it as the new value
-                # keep checking until the new value is < the old one
-                if cropYieldNew >= yearlyYield[year]:
-                    yearlyYield[year] = cropYieldNew
-                    harvestDates[year] = day.strftime('%Y-%m-%d')
-                else:
-                    check = False
-                    startDay = day
-        else:
-            print '*** Warning: no case for daily data for year {}'.format(year)
-    
-    yearlyYield = pandas.Series(yearlyYield)
-    harvestDates = pandas.Series(harvestDates)
+    Returns
+    -------
+    List of output field names.
+    '''
+    with apsimDbConn:
+        outputFields = psql.read_frame("SELECT * FROM outputFields;", apsimDbConn)
     
-    yearlyYieldData = pandas.DataFrame({'yield':yearlyYield, 
-                                   'harvest_date':harvestDates})
-                                   
-    return yearlyYieldData
+    return list(outputFields['name'])
     
-def _get_avg_data(apsimDbConn, pointDailyData, harvestDates, sowDate):
+def _get_avg_data(pointDailyData, harvestDates, sowDate, outputFields):
     '''
     Determines seasonal averages for data.
     
+    Each growing season runs from the sow date to the harvest date of its
+    year. Season means for every field are taken from running sums over
+    the daily rows, so the data is only passed over once.
+    
     Parameters
     ----------
-    apsimDbConn : sqlite connection object
-        connection to database
-    dailyData : pandas dataframe
+    pointDailyData : pandas dataframe
         daily data values, indexed by date
     harvestDates : pandas dataframe
         string date of harvesting, indexed by year
     sowDate : string
         date of sowing (dd-mmm)
+    outputFields : list
+        output field names from the outputFields table
         
     Returns
     -------
@@ -215,201 +466,280 @@ def _get_avg_data(apsimDbConn, pointDailyData, harvestDates, sowDate):
     # convert sowDate to correct format
     sowDate = strptime(sowDate,'%d-%b')
     
-    # read data from the outputFields table
-    with apsimDbConn:
-        outputFields = psql.read_frame("SELECT * FROM outputFields;", apsimDbConn)
-    outputFields = list(outputFields['name'])
-    outputFields.remove('date')
-    outputFields.remove('yield')
-    
-    yearlyAvgData = pandas.DataFrame({})
-    for field in outputFields:
-        dataAvgs = {}
-        for year in years:
-            harvestDate = harvestDates[year]
-            
-            # check if harvestDate is a string
-            if type(harvestDate) == type(''):
-                rng = pandas.date_range('{0}/{1}/{2}'.format(sowDate.tm_mon, sowDate.tm_mday, year), harvestDate)
-                
-                # get the avg values and add to dataAvgs dictionary
-                pointDailyDataMean = pointDailyData[field].ix[rng].mean()
-                dataAvgs[year] = pointDailyDataMean
-            else: # if harvestDate is not a string, set as NaN
-                dataAvgs[year] = np.nan
-
-        #print dataAvgs
-        yearlyAvgData[field] = pandas.Series(dataAvgs)
-        #print yearlyAvgData[field].head()
+    fields = [field for field in outputFields if field not in ('date', 'yield')]
+    
+    # seasons are only averaged when the harvest date is a string
+    harvestDates = harvestDates.reindex(years)
+    harvested = np.array([isinstance(h, str) for h in harvestDates], dtype=bool)
+    seasonStart = np.array(['{0}-{1:02d}-{2:02d}'.format(year, sowDate.tm_mon, sowDate.tm_mday) for year in years[harvested]], dtype='datetime64[D]')
+    seasonEnd = np.array(list(harvestDates[harvested]), dtype='datetime64[D]')
+    
+    # rows of each season
+    days = pointDailyData.index.values.astype('datetime64[D]')
+    first = np.searchsorted(days, seasonStart, side='left')
+    last = np.maximum(np.searchsorted(days, seasonEnd, side='right'), first)
+    
+    # running sums and counts of non-missing values for every field
+    values = np.asarray(pointDailyData[fields].values, dtype=float)
+    present = ~np.isnan(values)
+    sums = np.zeros((len(values) + 1, len(fields)))
+    counts = np.zeros((len(values) + 1, len(fields)))
+    np.cumsum(np.where(present, values, 0.0), axis=0, out=sums[1:])
+    np.cumsum(present, axis=0, out=counts[1:])
+    
+    dataAvgs = np.empty((len(years), len(fields)))
+    dataAvgs[:] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dataAvgs[harvested] = (sums[last] - sums[first]) / (counts[last] - counts[first])
+    
+    yearlyAvgData = pandas.DataFrame(dataAvgs, index=years, columns=fields)
                                    
     return yearlyAvgData
  
-def _get_db_info(apsimDbConn, maxChunksize=1500000):
+def _read_apsim_db(apsimDbConn, outputFields, batchsize=50000):
     '''
-    Gathers information from the database.
+    Reads apsimData.sqlite database a batch of points at a time.
+    
+    The apsimOutput table is walked once, ordered by point_id and date,
+    through a single cursor, so the rows of a point need not be stored
+    together (ie a database saved in parallel or resumed by ApsimRun).
+    Points may have different numbers of rows (e.g. a simulation that ended
+    early). Each batch holds the rows of whole points.
+    
+    Databases saved by utils.save_output_to_sqlite have an index on
+    (point_id, date), so SQLite reads the rows in order through the index
+    (the other fields are looked up in the table, the index does not cover
+    them). Older databases have no index and SQLite sorts the whole table
+    in a temporary B-tree first, which costs about one extra pass over the
+    table and temporary disk space of its size. The index is not added
+    here, as changing apsimData.sqlite would change the run's fingerprint
+    and have it processed again.
     
     Parameters
     ----------
     apsimDbConn : sqlite connection object
         connection to database
-    maxChunksize : int
-        (optional) maximum size of the chunks returned fromt the database.
-        Use to limit the number of rows returned when experiencing out of
-        memory errors.
+    outputFields : list
+        output field names from the outputFields table
+    batchsize : int
+        (optional) number of rows after which a batch is complete. Memory
+        use is bounded by this and the size of one point.
         
-    Returns
-    -------
-    Point Ids, optimal chunksize based on maxChunksize, and the number of 
-    points returned in each query from the database.
+    Yields
+    ------
+    Dataframe of the daily data of a batch of points (point_id, and the
+    output fields with date as datetimes), sorted by point_id and date.
     '''
-    with apsimDbConn:
-        # determine chunksize to read at a time
-        pointIds = pandas.io.sql.read_frame("SELECT DISTINCT point_id FROM apsimOutput", apsimDbConn)
+    sql = "SELECT point_id, {outputFields} FROM apsimOutput ORDER BY point_id, date".format(outputFields=', '.join(outputFields))
+    cursor = apsimDbConn.execute(sql)
+    rows = chain.from_iterable(iter(lambda: cursor.fetchmany(batchsize), []))
+    
+    batch = []
+    for pointId, pointRows in groupby(rows, key=itemgetter(0)):
+        batch.extend(pointRows)
+        if len(batch) >= batchsize:
+            yield _get_daily_data(batch, outputFields)
+            batch = []
+    if batch != []:
+        yield _get_daily_data(batch, outputFields)
+    
+def _get_daily_data(rows, outputFields):
+    '''Dataframe of (point_id, output fields...) rows, with date converted
+    to datetimes.'''
+    dailyData = pandas.DataFrame.from_records(rows, columns=['point_id'] + outputFields)
+    dailyData['date'] = pandas.to_datetime(dailyData['date'])
+    return dailyData
     
-    # convert to numpy array
-    pointIds = np.array(pointIds['point_id'])
+def _get_bounds(pointIds, pointId):
+    '''First and last + 1 row of pointId in a sorted array of point ids.'''
+    return np.searchsorted(pointIds, pointId), np.searchsorted(pointIds, pointId, side='right')
     
-    with apsimDbConn:
-        # assumes that all apsim simulation points have the same number of
-        # data points
-        # in cases where the apsim simulation failed to complete, this will
-        # cause problems.
-        pointDataSize = len(pandas.io.sql.read_frame("SELECT point_id FROM apsimOutput WHERE point_id={}".format(pointIds[0]), apsimDbConn))
+def _apsim_output(apsimDbPath, sowDates, verbose=True):
+    '''
+    Reads aspim data from the apsim run database.
     
-    numPoints = int(floor(maxChunksize / pointDataSize))
-    chunksize = pointDataSize * numPoints
-    #print 'pointDataSize:', pointDataSize
+    Yearly yields are found for a whole batch of points at once (see
+    _get_harvests), then seasonal averages point by point, as each point
+    has its own sow date.
+    
+    Parameters
+    ----------
+    apsimDbPath : string
+        path to apsim database
+    sowDates : pandas Series
+        dates of sowing for each location in the apsim simulation
+        (dd-mmm format)
+    verbose : bool
+        (optional) print each point as it is processed
+        
+    Yields
+    ------
+    Pandas dataframe of yearly apsim output for each point. Variables that
+    have more than one value per year (rain, mint, maxt, radn, etc.) are
+    averaged over the growing season.
+    '''
+    # open database
+    apsimDbConn = lite.connect(apsimDbPath)
     
-    return pointIds, chunksize, numPoints
+    # read data from the outputFields table
+    outputFields = _get_output_fields(apsimDbConn)
+    
+    # read main data a batch of points at a time
+    if verbose: print 'point num : point_id'
+    p = 0
+    for dailyData in _read_apsim_db(apsimDbConn, outputFields):
+        # get yearly yield data of every point in the batch
+        pointIds = dailyData['point_id'].values
+        yieldData = _get_harvests(pointIds, dailyData['date'].values, dailyData['yield'].values)
+        yieldPointIds = yieldData['point_id'].values
+        
+        for pointId in np.unique(pointIds):
+            p += 1
+            if verbose: print p, ':', pointId
+            
+            # set sow date
+            sowDate = sowDates.ix[pointId][0]
+            
+            # daily and yearly yield data of the point
+            first, last = _get_bounds(pointIds, pointId)
+            pointDailyData = dailyData.iloc[first:last].drop(['point_id'], axis=1).set_index('date')
+            first, last = _get_bounds(yieldPointIds, pointId)
+            yearlyYieldData = yieldData.iloc[first:last].set_index('sow_year')[['harvest_date', 'yield']]
+            yearlyYieldData.index.name = None
+            
+            # get yearly average data
+            harvestDates = yearlyYieldData['harvest_date']
+            yearlyAvgData = _get_avg_data(pointDailyData, harvestDates, sowDate, outputFields)
+            
+            # join yield and avg data, and make pretty
+            yearlyData = yearlyYieldData.join(yearlyAvgData)
+            yearlyData = yearlyData.reset_index()
+            yearlyData = yearlyData.rename(columns={'index':'sow_year'})
+            
+            # add pointId column to data
+            pointIdSeries = pandas.Series([pointId] * len(yearlyData))
+            yearlyData['point_id'] = pointIdSeries
+            
+            yield yearlyData
     
-def _read_apsim_db(apsimDbConn, start, chunksize):
+def _insert_apsim_output(masterDbConn, batch, runId):
     '''
-    Read apsimData.sqlite database.
+    Inserts a batch of yearly apsim output into the apsimOutput table,
+    creating the table for the batch's columns if it does not exist.
     
     Parameters
     ----------
-    apsimDbConn : sqlite connection object
-        connection to database
-    start : int
-        where to start limiting the data returned
-    chunksize : int
-        size of chunks to read from the database
+    masterDbConn : sqlite connection object
+        master database to connect to
+    batch : list
+        pandas dataframes of yearly apsim output
+    runId : int
+        run number the data belongs to
         
     Returns
     -------
-    A dataframe of daily data.
+    Number of rows inserted.
     '''
-    with apsimDbConn:
-        # read data from the outputFields table
-        outputFields = psql.read_frame("SELECT * FROM outputFields;", apsimDbConn)
-        outputFields = list(outputFields['name'])
-        outputFields = ', '.join(outputFields)
-        
-        # read main data
-        sql = "SELECT point_id, {outputFields} FROM apsimOutput LIMIT {start}, {chunksize}".format(outputFields=outputFields, start=start, chunksize=chunksize)
-        dailyData = pandas.io.sql.read_frame(sql, apsimDbConn)
+    batch = pandas.concat(batch, ignore_index=True)
+    batch['run_id'] = runId
     
-    return dailyData
+    # create apsimOutput table if it doesn't exist
+    if not _table_exists(masterDbConn, 'apsimOutput'):
+        sql, indexSqls = _get_apsim_output_schema(list(batch.columns))
+        masterDbConn.execute(sql)
+        for sql in indexSqls:
+            masterDbConn.execute(sql)
+    
+    columns = ', '.join('`{0}`'.format(column) for column in batch.columns)
+    valuesPlaceholder = ','.join('?' * len(batch.columns))
+    sql = "INSERT INTO apsimOutput (" + columns + ") VALUES (" + valuesPlaceholder + ")"
+    rows = izip(*[batch[column].tolist() for column in batch.columns])
+    masterDbConn.executemany(sql, rows)
     
-def _apsim_output(apsimDbPath, sowDates):
+    return len(batch)
+    
+def _write_apsim_output(masterDbConn, apsimData, runId, batchsize=10000):
     '''
-    Reads aspim data from the apsim run database.
+    Writes yearly apsim output to the apsimOutput table in batches.
+    
+    Yearly data is collected until batchsize rows are waiting, which are then
+    inserted with a single executemany. The caller is responsible for the
+    transaction, so a run is committed in one go.
     
     Parameters
     ----------
-    apsimDbPath : string
-        path to apsim database
-    sowDates : pandas Series
-        dates of sowing for each location in the apsim simulation
-        (dd-mmm format)
+    masterDbConn : sqlite connection object
+        master database to connect to
+    apsimData : iterable
+        pandas dataframes of yearly apsim output
+    runId : int
+        run number the data belongs to
+    batchsize : int
+        (optional) number of rows to insert at a time
         
     Returns
     -------
-    Pandas dataframe of yearly apsim output. Variables that have more than one
-    value per year (rain, mint, maxt, radn, etc.) are averaged over the growing
-    season.
+    Number of rows written.
     '''
-    # open database
-    apsimDbConn = lite.connect(apsimDbPath)
-    
-    # get pointIds, numPoints, and chunksize
-    print 'Getting database info...'
-    pointIds, chunksize, numPoints = _get_db_info(apsimDbConn)
-    print 'Number of points per chunk :', numPoints
-    
-    # read main data
-    start = 0
-    apsimData = pandas.DataFrame({})
-    print 'point num : point_id'
-    for p, pointId in enumerate(pointIds):
-        print p+1, ':', pointId
-        
-        # set sow date
-        sowDate = sowDates.ix[pointId][0]
-        
-        # read data in chunks so there will be enough memory
-        if p % numPoints == 0:
-            print 'Reading from database...'
-            dailyData = _read_apsim_db(apsimDbConn, start, chunksize)
-            #print dailyData.tail()
-            start += chunksize
-        
-        # set index to date column
-        pointDailyData = dailyData[dailyData['point_id'] == pointId]
-        pointDailyData = pointDailyData.drop(['point_id'], axis=1)
-        pointDailyData = pointDailyData.set_index('date')
-        
-        # convert to datetime index
-        pointDailyData.index = pandas.to_datetime(pointDailyData.index)
-    
-        # get yearly data
-        yearlyYieldData = _get_yearly_yield(pointDailyData['yield'])
-        
-        # get yearly average data
-        harvestDates = yearlyYieldData['harvest_date']
-        yearlyAvgData = _get_avg_data(apsimDbConn, pointDailyData, harvestDates, sowDate)
-        
-        # join yield and avg data, and make pretty
-        yearlyData = yearlyYieldData.join(yearlyAvgData)
-        yearlyData = yearlyData.reset_index()
-        yearlyData = yearlyData.rename(columns={'index':'sow_year'})
-        
-        # add pointId column to data
-        pointIdSeries = pandas.Series([pointId] * len(yearlyData))
-        yearlyData['point_id'] = pointIdSeries
-        
-        apsimData = apsimData.append(yearlyData, ignore_index=True)
-        
-    return apsimData
-    
-def update_apsim_output_table(masterDbConn, runPath, update):
+    numRows = 0
+    batch = []
+    batchRows = 0
+    for yearlyData in apsimData:
+        batch.append(yearlyData)
+        batchRows += len(yearlyData)
+        if batchRows >= batchsize:
+            numRows += _insert_apsim_output(masterDbConn, batch, runId)
+            batch = []
+            batchRows = 0
+    if batch != []:
+        numRows += _insert_apsim_output(masterDbConn, batch, runId)
+    
+    return numRows
+    
+def _replace_apsim_output(masterDbConn, apsimData, runId, update, fingerprint=None):
     '''
-    Updates the apsimOutput table in the master run database. If a run
-    is already there it is updated, otherwise it is added.
+    Replaces a run's rows in the apsimOutput table and records its
+    fingerprint as one transaction.
     
     Parameters
     ----------
     masterDbConn : sqlite connection object
         master database to connect to
-    runPath : string
-        path to the run folder for the apsimData.sqlite database for a 
-        particular run
+    apsimData : iterable
+        pandas dataframes of yearly apsim output
+    runId : int
+        run number the data belongs to
     update : bool
-        if the database needs to be updated or if it is the first commit for a
-        particular run
+        if rows of the run may already exist and need to be deleted first
+    fingerprint : tuple
+        (optional) fingerprint of the run (see get_run_fingerprint)
         
     Returns
     -------
     Nothing.
     '''
-    # get the runId
-    runId = int(os.path.split(runPath)[1])
+    with masterDbConn:
+        if update == True and _table_exists(masterDbConn, 'apsimOutput'):
+            masterDbConn.execute("DELETE FROM apsimOutput WHERE run_id=?", (runId,))
+        _write_apsim_output(masterDbConn, apsimData, runId)
+        if fingerprint is not None:
+            _save_run_fingerprint(masterDbConn, runId, fingerprint)
     
-    # don't do anything if the database is being updated
-    if update == True:
-        print "*** Warning: Run {} data may already exist. Skipping write.".format(runId)
-        return
+def _get_sow_dates(masterDbConn, runId):
+    '''
+    Reads the sow date of each location for a run.
     
+    Parameters
+    ----------
+    masterDbConn : sqlite connection object
+        master database to connect to
+    runId : int
+        run number to get sow dates for
+        
+    Returns
+    -------
+    Pandas dataframe of sow dates (dd-mmm format), indexed by point_id.
+    '''
     # get sow start from parameters table
     sql = "SELECT sow_start FROM runParameters WHERE run_id = {}".format(runId)
     sowStart = psql.read_frame(sql, masterDbConn).ix[0][0]
@@ -425,18 +755,44 @@ def update_apsim_output_table(masterDbConn, runPath, update):
         gridPoints = psql.read_frame(sql, masterDbConn)
         sowDates = pandas.DataFrame([sowStart] * len(gridPoints), index=gridPoints['point_id'])
     
+    return sowDates
+    
+def update_apsim_output_table(masterDbConn, runPath, update, fingerprint=None):
+    '''
+    Updates the apsimOutput table in the master run database. If a run
+    is already there it is updated, otherwise it is added.
+    
+    Parameters
+    ----------
+    masterDbConn : sqlite connection object
+        master database to connect to
+    runPath : string
+        path to the run folder for the apsimData.sqlite database for a 
+        particular run
+    update : bool
+        if the database needs to be updated or if it is the first commit for a
+        particular run
+    fingerprint : tuple
+        (optional) fingerprint of the run to record with its data (see
+        get_run_fingerprint)
+        
+    Returns
+    -------
+    Nothing.
+    '''
+    # get the runId
+    runId = int(os.path.split(runPath)[1])
+    
+    # get sow dates for each location
+    sowDates = _get_sow_dates(masterDbConn, runId)
+    
     # get the run database path
     apsimDbPath = os.path.join(runPath, 'data', 'apsimData.sqlite')
     
-    # read and convert to yearly formatted data
+    # read and convert to yearly formatted data, and replace the run's data
+    # in the master database in batches as one transaction
     apsimData = _apsim_output(apsimDbPath, sowDates)
-    
-    # add column with runId
-    runIdSeries = pandas.Series([runId] * len(apsimData))
-    apsimData['run_id'] = runIdSeries
-    
-    # write runData to master database
-    psql.write_frame(apsimData, 'apsimOutput', masterDbConn, if_exists='append')
+    _replace_apsim_output(masterDbConn, apsimData, runId, update, fingerprint)
 
 def update_output_fields_table(masterDbConn, runPath):
     '''
@@ -467,14 +823,34 @@ def update_output_fields_table(masterDbConn, runPath):
         outputFields = psql.read_frame("SELECT * FROM outputFields;", apsimDbConn)
         
     with masterDbConn:
-        # write outputFields to master database
-        try:
-            psql.write_frame(outputFields, 'outputFields', masterDbConn)
-        except ValueError:# as e: # if table already exists then do nothing
-            #print '*** Warning: {} Skipping write.'.format(e)
-            pass
+        # write outputFields to master database, skipping existing fields
+        sql = "INSERT OR IGNORE INTO outputFields (name, units) VALUES (?, ?)"
+        masterDbConn.executemany(sql, izip(outputFields['name'].tolist(), outputFields['units'].tolist()))
     
-def update_masterDb(masterDbPath, gridLutPath, startRun, endRun):
+def _get_run_output(args):
+    '''
+    Reads a run's apsim database and converts it to yearly data. Used by the
+    worker processes of update_masterDb.
+    
+    Parameters
+    ----------
+    args : tuple
+        path to the run folder and the run's sow dates (see _get_sow_dates)
+        
+    Returns
+    -------
+    The run path and a list holding the run's yearly apsim output as one
+    dataframe (empty if the run has no output).
+    '''
+    runPath, sowDates = args
+    apsimDbPath = os.path.join(runPath, 'data', 'apsimData.sqlite')
+    apsimData = list(_apsim_output(apsimDbPath, sowDates, verbose=False))
+    if apsimData != []:
+        apsimData = [pandas.concat(apsimData, ignore_index=True)]
+    
+    return runPath, apsimData
+    
+def update_masterDb(masterDbPath, gridLutPath, startRun, endRun, numCPU=1):
     '''
     Convenience function for updating everything in the master run
     database.
@@ -489,6 +865,10 @@ def update_masterDb(masterDbPath, gridLutPath, startRun, endRun):
         run number to start processing on
     endRun : int
         (optional) run number to stop processing on; inclusive
+    numCPU : int
+        (optional) number of worker processes converting run databases to
+        yearly data. Data is always written by this process. If 1, runs are
+        processed one after another without worker processes.
         
     Returns
     -------
@@ -504,39 +884,92 @@ def update_masterDb(masterDbPath, gridLutPath, startRun, endRun):
         endRun = startRun # inclusive
     runs = range(startRun, endRun+1)
     
-    # read grid lookup table
-    gridLut = pandas.read_csv(gridLutPath)
+    # read grid lookup table (cached, see gridlut.load_grid_lut)
+    gridLut = gridlut.load_grid_lut(gridLutPath)
     
     # open run database
     # check to see if the file exists. If it doesn't create gridPoints table
     if os.path.isfile(masterDbPath):
         masterDbConn = lite.connect(masterDbPath)
+        
+        # upgrade databases created by older versions
+        migrate_schema(masterDbConn)
     else:
         # first time opening it
         masterDbConn = lite.connect(masterDbPath)
         
         # create tables
         create_tables(masterDbConn, gridLut)
+    
+    # find runs that are new or have changed since they were last saved
+    changedRuns = []
+    for run in runs:
+        runPath = os.path.join(os.path.split(masterDbPath)[0], str(run))
+        configPath = os.path.join(runPath, 'config.ini')
+        apsimDbPath = os.path.join(runPath, 'data', 'apsimData.sqlite')
+        if not (os.path.isfile(configPath) and os.path.isfile(apsimDbPath)):
+            print '*** Warning: Run {0} is missing {1} or {2}. Skipping.'.format(run, configPath, apsimDbPath)
+            continue
+        
+        fingerprint, changed = get_run_fingerprint(masterDbConn, runPath)
+        if changed:
+            changedRuns.append((run, runPath, fingerprint))
+        else:
+            print 'Run {0} unchanged. Skipping.'.format(run)
         
     # update database with data from each run
-    numRuns = len(runs)
-    with masterDbConn:
-        for r, run in enumerate(runs):
-            # print progress
-            print 'Saving run: {0} ({1}/{2})...'.format(run, r+1, numRuns)
-            
-            # get paths
-            runPath = os.path.join(os.path.split(masterDbPath)[0], str(run))
-            configPath = os.path.join(runPath, 'config.ini')
-            
-            # update runParameters table
-            update = update_run_parameters_table(masterDbConn, configPath)
-            
-            # update apsimOutput table
-            update_apsim_output_table(masterDbConn, runPath, update)
-            
-            # update outputFields table
-            update_output_fields_table(masterDbConn, runPath)
+    numRuns = len(changedRuns)
+    if numCPU == 1 or numRuns < 2:
+        # no worker processes for nothing or a single run
+        with masterDbConn:
+            for r, (run, runPath, fingerprint) in enumerate(changedRuns):
+                # print progress
+                print 'Saving run: {0} ({1}/{2})...'.format(run, r+1, numRuns)
+                
+                # get paths
+                configPath = os.path.join(runPath, 'config.ini')
+                
+                # update runParameters table
+                update = update_run_parameters_table(masterDbConn, configPath)
+                
+                # update apsimOutput table
+                update_apsim_output_table(masterDbConn, runPath, update, fingerprint)
+                
+                # update outputFields table
+                update_output_fields_table(masterDbConn, runPath)
+    else:
+        # update runParameters and outputFields tables, and collect the runs
+        # for the workers
+        jobs = []
+        runUpdates = {}
+        with masterDbConn:
+            for run, runPath, fingerprint in changedRuns:
+                # get paths
+                configPath = os.path.join(runPath, 'config.ini')
+                
+                # update runParameters table
+                update = update_run_parameters_table(masterDbConn, configPath)
+                
+                # update outputFields table
+                update_output_fields_table(masterDbConn, runPath)
+                
+                runUpdates[runPath] = (update, fingerprint)
+                jobs.append((runPath, _get_sow_dates(masterDbConn, run)))
+        
+        # convert runs in worker processes and write each one as it finishes
+        print 'Processing {0} runs with {1} processes...'.format(numRuns, numCPU)
+        pool = mp.Pool(min(numCPU, numRuns))
+        try:
+            for r, (runPath, apsimData) in enumerate(pool.imap_unordered(_get_run_output, jobs)):
+                runId = int(os.path.split(runPath)[1])
+                update, fingerprint = runUpdates[runPath]
+                _replace_apsim_output(masterDbConn, apsimData, runId, update, fingerprint)
+                print 'Saved run: {0} ({1}/{2})'.format(runId, r+1, numRuns)
+            pool.close()
+        finally:
+            # stop the workers if a run failed
+            pool.terminate()
+            pool.join()
                 
     print '\n***** Done! *****'
 
@@ -547,4 +980,5 @@ if __name__ == '__main__':
     gridLutPath = 'C:/ExampleProject/lookupTables/exampleLookupTable.csv'
     startRun = 1
     endRun = 1
-    update_masterDb(masterDbPath, gridLutPath, startRun, endRun)
+    numCPU = 1
+    update_masterDb(masterDbPath, gridLutPath, startRun, endRun, numCPU)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#==============================================================================
+# benchmark of analysis queries against a master run database, before and
+# after migrating it to the indexed schema in masterRunDb.py
+#==============================================================================
+
+import os, shutil, tempfile
+from time import time
+import numpy as np
+import pandas
+from pandas.io import sql as psql
+import sqlite3 as lite
+import masterRunDb
+
+def _create_legacy_db(masterDbPath, numRuns, numPoints, numYears):
+    '''
+    Creates a master run database of random yearly data the way older
+    versions of masterRunDb.py wrote it (pandas.io.sql.write_frame, no
+    primary keys or indexes).
+    
+    Parameters
+    ----------
+    masterDbPath : string
+        path to save the database to
+    numRuns : int
+        number of runs
+    numPoints : int
+        number of grid points in each run
+    numYears : int
+        number of years in each run
+    
+    Returns
+    -------
+    Nothing.
+    '''
+    masterDbConn = lite.connect(masterDbPath)
+    pointIds = np.arange(1, numPoints + 1)
+    years = np.arange(2001, 2001 + numYears)
+    
+    gridPoints = pandas.DataFrame({'point_id':pointIds, 'sow_start':['8-Jun'] * numPoints})
+    psql.write_frame(gridPoints, 'gridPoints', masterDbConn)
+    outputFields = pandas.DataFrame({'name':['date', 'yield', 'rain'], 'units':['(yyyy-mm-dd)', '(kg/ha)', '(mm)']})
+    psql.write_frame(outputFields, 'outputFields', masterDbConn)
+    
+    for run in range(1, numRuns + 1):
+        numRows = numPoints * numYears
+        apsimData = pandas.DataFrame({'sow_year':np.tile(years, numPoints),
+                                      'harvest_date':['2001-10-01'] * numRows,
+                                      'yield':np.random.uniform(0, 10000, numRows),
+                                      'rain':np.random.uniform(0, 10, numRows),
+                                      'point_id':np.repeat(pointIds, numYears),
+                                      'run_id':[run] * numRows})
+        psql.write_frame(apsimData, 'apsimOutput', masterDbConn, if_exists='append')
+    
+    masterDbConn.close()
+
+def _time_queries(masterDbConn, queries, repeat):
+    '''Returns the best runtime (s) of each query over repeat runs.'''
+    runtimes = []
+    for sql in queries:
+        best = None
+        for _ in range(repeat):
+            timeOld = time()
+            masterDbConn.execute(sql).fetchall()
+            runtime = time() - timeOld
+            if best == None or runtime < best:
+                best = runtime
+        runtimes.append(best)
+    return runtimes
+
+def main(numRuns=20, numPoints=2000, numYears=20, repeat=3):
+    '''
+    Times typical analysis queries on a legacy master run database, migrates
+    it with masterRunDb.migrate_schema and times them again.
+    
+    Parameters
+    ----------
+    numRuns : int
+        (optional) number of runs in the database
+    numPoints : int
+        (optional) number of grid points in each run
+    numYears : int
+        (optional) number of years in each run
+    repeat : int
+        (optional) number of times each query is run
+    
+    Returns
+    -------
+    Nothing.
+    '''
+    queries = ["SELECT sow_year, AVG(yield) FROM apsimOutput WHERE run_id = {0} GROUP BY sow_year".format(numRuns // 2),
+               "SELECT sow_year, yield FROM apsimOutput WHERE run_id = {0} AND point_id = {1}".format(numRuns // 2, numPoints // 2),
+               "SELECT run_id, sow_year, yield FROM apsimOutput WHERE point_id = {0}".format(numPoints // 2),
+               "SELECT run_id, AVG(yield) FROM apsimOutput WHERE sow_year = 2005 GROUP BY run_id"]
+    
+    tempDir = tempfile.mkdtemp()
+    try:
+        masterDbPath = os.path.join(tempDir, 'benchmark.sqlite')
+        print 'Creating database ({0} rows)...'.format(numRuns * numPoints * numYears)
+        _create_legacy_db(masterDbPath, numRuns, numPoints, numYears)
+        
+        masterDbConn = lite.connect(masterDbPath)
+        legacyRuntimes = _time_queries(masterDbConn, queries, repeat)
+        timeOld = time()
+        masterRunDb.migrate_schema(masterDbConn)
+        migrationRuntime = time() - timeOld
+        runtimes = _time_queries(masterDbConn, queries, repeat)
+        masterDbConn.close()
+    finally:
+        shutil.rmtree(tempDir)
+    
+    print 'Migration runtime : {0:.2f} s'.format(migrationRuntime)
+    print '{0:>12} {1:>12} {2:>8} : query'.format('legacy (ms)', 'indexed (ms)', 'speedup')
+    for sql, legacyRuntime, runtime in zip(queries, legacyRuntimes, runtimes):
+        print '{0:12.2f} {1:12.2f} {2:7.1f}x : {3}'.format(legacyRuntime * 1000, runtime * 1000, legacyRuntime / max(runtime, 1e-6), sql)
+
+# Run if module is run as a program
+if __name__ == '__main__':
+    main()
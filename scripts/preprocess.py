@@ -4,13 +4,15 @@
 # main file for creating apsimRegion experiments
 #==============================================================================
 
-import os
+import os, sys
+import multiprocessing as mp
 from apsimRegions.preprocess.configMaker import create_many_config_files
 from apsimRegions.preprocess.apsimPreprocess import preprocess_many
 from apsimRegions.preprocess.batch import create_run_all_batchfile
 
 def main():
     experimentName = 'test'
+    numCPU = mp.cpu_count() # processes to create .apsim files with
     outputDir = 'C:/ExampleProject/output/experiments/maize/{0}'.format(experimentName)
     
     # validArgs are 'resolution','crop','model','crit_fr_asw', 'sowStart', or 'soilName'
@@ -32,7 +34,14 @@ def main():
     
     # create apsim files
     print 'Saving .apsim and .bat files...'
-    preprocess_many(outputDir, runs.keys()[0], runs.keys()[-1])
+    failed = preprocess_many(outputDir, runs.keys()[0], runs.keys()[-1], numCPU)
+    
+    # an experiment with missing runs is not run
+    if failed != []:
+        print '*** Error: {0} runs failed. The run all batch file was not saved.'.format(len(failed))
+        for configPath in failed:
+            print '    {0}'.format(configPath)
+        sys.exit(1)
     
     # create run all batchfile
     create_run_all_batchfile(outputDir, runs, experimentName)
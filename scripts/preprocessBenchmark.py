@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#==============================================================================
+# benchmarks for creating .apsim files with the example lookup table, met
+# files and soils
+#==============================================================================
+
+import os, shutil, tempfile
+from time import time
+import lxml.etree as ET
+from pandas import read_csv
+from apsimRegions.preprocess import configMaker, fileio, apsimconfig, soils, gridlut
+
+examplesDir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, 'examples'))
+
+def _create_config(outputDir, numPoints=None, **kwargs):
+    '''
+    Saves a configuration file for the example data.
+
+    Parameters
+    ----------
+    outputDir : string
+        directory to save config.ini (and the lookup table) to
+    numPoints : int
+        (optional) number of grid points. The example lookup table is
+        repeated, with new point ids, to make up numPoints.
+    kwargs : keyword arguments
+        (optional) other arguments to configMaker.create_config_file
+
+    Returns
+    -------
+    fileio.Config object of the configuration file.
+    '''
+    gridLutPath = os.path.join(examplesDir, 'exampleLookupTable.csv')
+    if numPoints != None:
+        gridLut = read_csv(gridLutPath)
+        gridLut = gridLut.iloc[[n % len(gridLut) for n in range(numPoints)]].copy()
+        gridLut['point_id'] = range(1, numPoints + 1)
+        gridLutPath = os.path.join(outputDir, 'lookupTable.csv')
+        gridLut.to_csv(gridLutPath, index=False)
+
+    configPath = os.path.join(outputDir, 'config.ini')
+    configMaker.create_config_file(configPath, gridLutPath,
+                                   os.path.join(examplesDir, 'metfiles', '%(met)s'),
+                                   soilDataPath=os.path.join(examplesDir, 'soils', 'hc27_v1_1.soils'),
+                                   sowStart='auto', **kwargs)
+    return fileio.Config(configPath)
+
+def _get_parse_time(path, repeat=10):
+    '''Average time (s) to parse an XML file into a full tree, as a stand-in
+    for ApsimToSim reading an .apsim file.'''
+    timeOld = time()
+    for _ in range(repeat):
+        ET.parse(path)
+    return (time() - timeOld) / repeat
+
+def benchmark_referenced_soils():
+    '''
+    Compares the .apsim file of the example lookup table, which only holds
+    the soils its grid points use, with the same file holding every soil in
+    the soils file.
+
+    Returns
+    -------
+    Sizes (bytes) and parse times (s) of the file with all soils and with
+    referenced soils only.
+    '''
+    outputDir = tempfile.mkdtemp()
+    try:
+        config = _create_config(outputDir)
+        apsimPath = os.path.join(outputDir, apsimconfig.new_apsim(outputDir, config))
+
+        # the same file with every soil in the shared soils folder
+        doc = ET.parse(apsimPath).getroot()
+        soilfolder = doc.find('folder[@name="Shared Soils"]')
+        numSoils = len(soilfolder)
+        soilfolder.clear()
+        soilfolder.set('name', 'Shared Soils')
+        library = soils.load_library(config.soilDataPath)
+        library.add_soils(soilfolder)
+        allSoilsPath = os.path.join(outputDir, 'allSoils.apsim')
+        with open(allSoilsPath, 'wb') as f:
+            f.write(ET.tostring(doc, pretty_print=True, encoding='UTF-8'))
+
+        sizes = (os.path.getsize(allSoilsPath), os.path.getsize(apsimPath))
+        parseTimes = (_get_parse_time(allSoilsPath), _get_parse_time(apsimPath))
+    finally:
+        shutil.rmtree(outputDir)
+
+    print 'Soils embedded in .apsim file'
+    print '    all soils        : {0:3} soils, {1:8.0f} kB, parsed in {2:.2f} ms'.format(len(library.names), sizes[0] / 1024., parseTimes[0] * 1000)
+    print '    referenced soils : {0:3} soils, {1:8.0f} kB, parsed in {2:.2f} ms ({3:.1f}x smaller)'.format(numSoils, sizes[1] / 1024., parseTimes[1] * 1000, float(sizes[0]) / sizes[1])
+    return sizes, parseTimes
+
+def benchmark_new_apsim(numPoints=50000):
+    '''
+    Times apsimconfig.new_apsim for numPoints grid points, streaming the
+    simulations to the .apsim file, against the time to only write a file
+    of the same size, and prints the time of each step of new_apsim.
+    
+    Returns
+    -------
+    Runtimes (s) of new_apsim and of writing the file.
+    '''
+    outputDir = tempfile.mkdtemp()
+    try:
+        config = _create_config(outputDir, numPoints, streamSimulations='yes')
+        soils.load_library(config.soilDataPath)
+        
+        timer = apsimconfig.StepTimer()
+        timeOld = time()
+        apsimPath = os.path.join(outputDir, apsimconfig.new_apsim(outputDir, config, timer))
+        runtime = time() - timeOld
+        
+        with open(apsimPath, 'rb') as f:
+            xml = f.read()
+        timeOld = time()
+        with open(os.path.join(outputDir, 'copy.apsim'), 'wb') as f:
+            f.write(xml)
+            f.flush()
+            os.fsync(f.fileno())
+        writeRuntime = time() - timeOld
+    finally:
+        shutil.rmtree(outputDir)
+    
+    print 'new_apsim, {0} grid points ({1:.0f} MB)'.format(numPoints, len(xml) / 1024. ** 2)
+    print '    new_apsim    : {0:6.2f} s ({1:.0f} points/s)'.format(runtime, numPoints / runtime)
+    print '    write only   : {0:6.2f} s'.format(writeRuntime)
+    timer.report(numPoints)
+    return runtime, writeRuntime
+
+def benchmark_load_grid_lut(numPoints=50000):
+    '''
+    Times reading a lookup table of numPoints grid points with pandas, with
+    gridlut.load_grid_lut from its on-disk cache (as a new process would)
+    and from the table already loaded, and looking up the sowing date of
+    every point in the pandas table and in the GridLut.
+    
+    Returns
+    -------
+    Runtimes (s) of read_csv, loading from the disk cache and from memory,
+    and of the lookups in pandas and in the GridLut.
+    '''
+    outputDir = tempfile.mkdtemp()
+    try:
+        config = _create_config(outputDir, numPoints)
+        gridlut.load_grid_lut(config.gridLutPath, cacheDir=outputDir)
+        
+        timeOld = time()
+        table = read_csv(config.gridLutPath, index_col='point_id')
+        csvRuntime = time() - timeOld
+        
+        gridlut._tables.clear()
+        timeOld = time()
+        gridLut = gridlut.load_grid_lut(config.gridLutPath, cacheDir=outputDir)
+        diskRuntime = time() - timeOld
+        
+        timeOld = time()
+        gridlut.load_grid_lut(config.gridLutPath, cacheDir=outputDir)
+        memoryRuntime = time() - timeOld
+        
+        timeOld = time()
+        for gridpoint in table.index:
+            table['sow_start'][gridpoint]
+        pandasLookupRuntime = time() - timeOld
+        
+        timeOld = time()
+        for gridpoint in gridLut.index:
+            gridLut.lookup('sow_start')[gridpoint]
+        lookupRuntime = time() - timeOld
+    finally:
+        shutil.rmtree(outputDir)
+    
+    print 'Lookup table of {0} grid points'.format(numPoints)
+    print '    read_csv           : {0:8.2f} ms'.format(csvRuntime * 1000)
+    print '    load, disk cache   : {0:8.2f} ms ({1:.1f}x)'.format(diskRuntime * 1000, csvRuntime / diskRuntime)
+    print '    load, in memory    : {0:8.2f} ms'.format(memoryRuntime * 1000)
+    print '    lookups, pandas    : {0:8.2f} ms'.format(pandasLookupRuntime * 1000)
+    print '    lookups, GridLut   : {0:8.2f} ms ({1:.0f}x)'.format(lookupRuntime * 1000, pandasLookupRuntime / lookupRuntime)
+    return csvRuntime, diskRuntime, memoryRuntime, pandasLookupRuntime, lookupRuntime
+
+# Run if module is run as a program
+if __name__ == '__main__':
+    benchmark_referenced_soils()
+    benchmark_load_grid_lut()
+    benchmark_new_apsim()